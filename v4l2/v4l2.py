@@ -616,8 +616,13 @@ V4L2_BUF_FLAG_DONE = 0x0004
 V4L2_BUF_FLAG_KEYFRAME = 0x0008
 V4L2_BUF_FLAG_PFRAME = 0x0010
 V4L2_BUF_FLAG_BFRAME = 0x0020
+V4L2_BUF_FLAG_ERROR = 0x0040
 V4L2_BUF_FLAG_TIMECODE = 0x0100
 V4L2_BUF_FLAG_INPUT = 0x0200
+V4L2_BUF_FLAG_TIMESTAMP_MASK = 0xe000
+V4L2_BUF_FLAG_TIMESTAMP_UNKNOWN = 0x0000
+V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC = 0x2000
+V4L2_BUF_FLAG_TIMESTAMP_COPY = 0x4000
 
 
 #
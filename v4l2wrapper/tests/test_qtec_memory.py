@@ -0,0 +1,100 @@
+'''
+    Tests for the qtec memory allocator, using a temporary file in place
+    of the qtec memory device
+'''
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import mmap
+import ctypes as ct
+from v4l2wrapper._wrappers.qtec_memory import qtec_memory, qtec_mem_error
+
+PAGE = mmap.PAGESIZE
+PAGES = 8
+
+class QtecMemoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile()
+        self.file.truncate(PAGES * PAGE)
+        self.mem = qtec_memory(self.file.name, PAGES * PAGE)
+        self.buffs = []
+
+    def tearDown(self):
+        while self.buffs:
+            buff = self.buffs.pop()
+            if self.mem.owns(buff):
+                self.mem.release(buff)
+        buff = None
+        if not self.mem._mmap.closed:
+            self.mem.close()
+        self.file.close()
+
+    def alloc(self, size):
+        buff = self.mem.get_next_memory_frame(size)
+        self.buffs.append(buff)
+        return buff
+
+    def test_page_aligned(self):
+        a = self.alloc(1)
+        b = self.alloc(PAGE + 1)
+        c = self.alloc(PAGE)
+        self.assertEqual(ct.addressof(b) - ct.addressof(a), PAGE)
+        self.assertEqual(ct.addressof(c) - ct.addressof(b), 2 * PAGE)
+        self.assertEqual(ct.sizeof(b), PAGE + 1)
+        self.assertEqual(self.mem.stats()['used'], 4 * PAGE)
+
+    def test_first_fit(self):
+        buffs = [self.alloc(PAGE) for i in range(4)]
+        start = ct.addressof(buffs[0])
+        #free blocks of one and two pages, the second one fits two pages
+        self.mem.release(buffs[0])
+        self.mem.release(buffs[2])
+        self.mem.release(buffs[3])
+        self.assertEqual(self.mem.stats()['free_blocks'], 2)
+        big = self.alloc(2 * PAGE)
+        self.assertEqual(ct.addressof(big) - start, 2 * PAGE)
+        small = self.alloc(PAGE)
+        self.assertEqual(ct.addressof(small), start)
+
+    def test_release_coalesces(self):
+        buffs = [self.alloc(PAGE) for i in range(PAGES)]
+        self.assertRaises(qtec_mem_error, self.alloc, 1)
+        for i in (1, 3, 2, 0, 5, 7, 6, 4):
+            self.mem.release(buffs[i])
+        stats = self.mem.stats()
+        self.assertEqual(stats['free_blocks'], 1)
+        self.assertEqual(stats['largest_free'], PAGES * PAGE)
+        self.assertEqual(stats['used'], 0)
+        self.assertEqual(stats['peak_used'], PAGES * PAGE)
+        #the whole memory is available again
+        self.alloc(PAGES * PAGE)
+
+    def test_release_foreign(self):
+        buff = self.alloc(PAGE)
+        self.mem.release(buff)
+        self.assertFalse(self.mem.owns(buff))
+        self.assertRaises(qtec_mem_error, self.mem.release, buff)
+        self.assertRaises(qtec_mem_error, self.mem.release, (ct.c_char * PAGE)())
+
+    def test_close(self):
+        buff = self.alloc(PAGE)
+        self.assertRaises(qtec_mem_error, self.mem.close)
+        self.mem.release(buff)
+        del buff
+        del self.buffs[:]
+        self.mem.close()
+
+    def test_size(self):
+        self.assertRaises(qtec_mem_error, qtec_memory, self.file.name, PAGE - 1)
+        #the file is smaller than the memory
+        self.assertRaises(qtec_mem_error, qtec_memory, self.file.name, (PAGES + 1) * PAGE)
+        mem = qtec_memory(self.file.name, 2 * PAGE + 1)
+        self.assertEqual(mem.size, 2 * PAGE)
+        mem.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,8 +9,7 @@
 from v4l2wrapper._device_wrapper import create_device_wrapper, WrapperException, _init_map
 from v4l2wrapper._v4lconvert import v4l2_Capture_Data_Converter
 
-#initialize the device wrapper
-_init_map()
+#wrappers are loaded on demand by create_device_wrapper, see _wrappers/__init__.py
 
 
 __all__ = ['create_device_wrapper',
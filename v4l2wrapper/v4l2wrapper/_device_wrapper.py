@@ -8,10 +8,10 @@
 
 import os, re
 import logging
-import v4l2
 import fcntl
 import copy
 import itertools, types
+from v4l2wrapper._wrappers import WRAPPER_MANIFEST
 
 #SETS BASIC CONFIG LEVEL
 #FINE GRAINED DEBUG AT LOGGING LEVEL 5
@@ -25,7 +25,7 @@ class _mdata():
     device_class_idetifier = 'v4l2Device'
     device_subdir    = '/_wrappers'
     device_list = []
-    ignoreList = ['v4l2_device_Base.py', 'v4l2_device_template.py']
+    loaded_wrappers = {}
 
 
 class WrapperException(Exception):
@@ -38,28 +38,49 @@ class WrapperException(Exception):
 ''' private methods '''
 
 def _init_map():
-    ''' initialize the device wrapper map'''
-    path = os.path.dirname(os.path.abspath(__file__)) + _mdata.device_subdir
-    if not os.path.isdir(path):
-        logging.debug('Device directory not found: ' + path)
-        return
-    for f in os.listdir(path):
-        if f.startswith(_mdata.device_file_identifier) and f.endswith('.py') and f not in _mdata.ignoreList:
-            m = 'v4l2wrapper.{}.{}'.format(_mdata.device_subdir[1:], f[:-3])
-            try:
-                m = __import__(m, globals(), locals(), ['object'], 0)
-            except Exception as e:
-                if THROWING_EXEPT:
-                    raise e
-                else:
-                    logging.debug('Exception from wrapper ' + str(m) + ' : ' + str(e))
-                    continue
-            for cls_name in [o for o in dir(m) if o.startswith(_mdata.device_class_idetifier)]:
-                cls = getattr(m, cls_name)
-                if cls not in _mdata.device_list:
-                    _mdata.device_list.append(cls)
+    ''' load every wrapper in the manifest, regardless of the device.
+        create_device_wrapper only loads the wrappers it needs, this is
+        kept for inspecting the full wrapper list'''
+    for (module, cls_name, caps, keywords) in WRAPPER_MANIFEST:
+        cls = _load_wrapper(module, cls_name)
+        if cls is not None and cls not in _mdata.device_list:
+            _mdata.device_list.append(cls)
+
+def _load_wrapper(module, cls_name):
+    ''' imports a wrapper module on first use and returns the wrapper class.
+        Failed imports are remembered and return None'''
+    key = (module, cls_name)
+    if key in _mdata.loaded_wrappers:
+        return _mdata.loaded_wrappers[key]
+    cls = None
+    m = 'v4l2wrapper.{}.{}'.format(_mdata.device_subdir[1:], module)
+    try:
+        m = __import__(m, globals(), locals(), ['object'], 0)
+        cls = getattr(m, cls_name)
+    except Exception as e:
+        if THROWING_EXEPT:
+            raise e
+        logging.debug('Exception from wrapper ' + str(m) + ' : ' + str(e))
+    _mdata.loaded_wrappers[key] = cls
+    return cls
+
+def _matching_wrappers(cp, kwargs):
+    ''' returns the wrapper classes whose manifest requirements are met by
+        the device capabilities and the passed keywords'''
+    import v4l2
+    wrappers = []
+    for (module, cls_name, caps, keywords) in WRAPPER_MANIFEST:
+        if not all(cp.capabilities & getattr(v4l2, c) for c in caps):
+            continue
+        if not all(k in kwargs for k in keywords):
+            continue
+        cls = _load_wrapper(module, cls_name)
+        if cls is not None and cls not in wrappers:
+            wrappers.append(cls)
+    return wrappers
 
 def _get_device_info(device_path, pixelformat = None):
+    import v4l2
     try:
         fd = os.open(device_path, os.O_RDWR)
     except IOError:
@@ -82,11 +103,13 @@ def _get_device_info(device_path, pixelformat = None):
     return fmt, cp
 
 def _get_capability(fd):
+    import v4l2
     cp = v4l2.v4l2_capability()
     fcntl.ioctl(fd, v4l2.VIDIOC_QUERYCAP, cp)
     return cp
 
 def _get_fmt(fd):
+    import v4l2
     fmt = v4l2.v4l2_format()
     fmt.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
     fcntl.ioctl(fd, v4l2.VIDIOC_G_FMT, fmt)
@@ -152,7 +175,7 @@ def create_device_wrapper(device_path=None, pixelformat=None, **kwargs):
     #_mdata.device_list=[device_path]
     #print(_mdata)
     #print("_mdata.device_list", _mdata.device_list)
-    for i in _mdata.device_list:
+    for i in _matching_wrappers(cp, kwargs):
         try:
             tmp = i((device_path,fmt,cp,temp_kwargs))
             del (tmp)
@@ -9,8 +9,7 @@
 ''' interface with libv4lconvert '''
 ''' provides wrapper for converting read images into a different format'''
 
-import ctypes, logging, v4l2, select, time, os
-import numpy as np
+import ctypes, logging, select, time, os
 
 
 #making it as a context manager
@@ -31,9 +30,12 @@ class v4l2_Capture_Data_Converter(object):
             self.logger.warning('Device wrapper does not support RW Capability, returning None')
             return None
 
-        self.device_wrapper.open_fd()
+        #the capture fd is kept open by the wrapper, only open it if needed
+        self._opened_fd = not self.device_wrapper.fd
+        if self._opened_fd:
+            self.device_wrapper.open_fd()
         if self._libso is not None:
-            self._data_pointer = self._libso.v4lconvert_create(self.device_wrapper.fd.fileno())
+            self._data_pointer = self._libso.v4lconvert_create(self.device_wrapper.fd)
         #    res = _libso.v4lconvert_try_format(self._data_pointer, ctypes.addressof(self.target_format),
         #            self.device_wrapper.get_fmt())
         #    if res == 0:
@@ -48,22 +50,29 @@ class v4l2_Capture_Data_Converter(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self._data_pointer:
-            _libso.v4lconvert_destroy(self._data_pointer)
-        self.device_wrapper.close_fd()
+            self._libso.v4lconvert_destroy(self._data_pointer)
+        if self._opened_fd:
+            self.device_wrapper.close_fd()
         return False
 
     def converted_capture(self, timeout=None, fmt=None):
+        #imported here to keep 'import v4l2wrapper' light
+        import v4l2
+        import numpy as np
         dev = self.device_wrapper
         if not timeout:
             timeout = self.device_wrapper.capture_timeout
         if fmt:
             self.target_format = fmt.fmt.pix.pixelformat
 
-        dev.open_fd()
+        if not dev.fd:
+            dev.open_fd()
+        start = dev._tstamp()
         if (timeout>=0):
             ready = select.select([dev.fd], [], [], timeout)
             if not ready[0]:
                 return None
+        start = dev._tstage('poll', start)
 
         if  ((self.target_format == v4l2.V4L2_PIX_FMT_Y10) or
              (self.target_format == v4l2.V4L2_PIX_FMT_Y12) or
@@ -103,6 +112,9 @@ class v4l2_Capture_Data_Converter(object):
             tar_addr = ctypes.cast(tar_addr, ctypes.POINTER(ctypes.c_ubyte))
             #read from file
             data = dev.raw_read(dev_fmt.fmt.pix.sizeimage)
+            if len(data) < dev_fmt.fmt.pix.sizeimage:
+                #partial frame, dropped
+                return None
             src_buff= (ctypes.c_char*dev_fmt.fmt.pix.sizeimage).from_buffer_copy(data)
             src_addr = ctypes.addressof(src_buff)
             src_addr = ctypes.cast(src_addr, ctypes.POINTER(ctypes.c_ubyte))
@@ -114,10 +126,13 @@ class v4l2_Capture_Data_Converter(object):
             else:
                 data = None
         else:
-            buf = os.read(self.fd, fmt.fmt.pix.height * fmt.fmt.pix.width * colors)
-            self.close_fd()
+            nbytes = fmt.fmt.pix.height * fmt.fmt.pix.width * colors * np.dtype(pixformat).itemsize
+            buf = os.read(dev.fd, nbytes)
+            if len(buf) < nbytes:
+                #partial frame, dropped
+                return None
             data = np.frombuffer(buf, dtype=pixformat)
-        dev.close_fd()
+        start = dev._tstage('convert', start)
 
         if data is None or data.size == 0:
             return None
@@ -155,5 +170,6 @@ class v4l2_Capture_Data_Converter(object):
             rgb[:, :, 5] = (298 * (y2 - 16) + 516 * (u - 128) + 128) / 256
             rgb = np.clip(rgb, 0, 255)
             data = rgb.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width, 3)).astype('uint8')
+        dev._tstage('decode', start)
 
         return data
\ No newline at end of file
@@ -0,0 +1,31 @@
+'''
+    Wrapper manifest
+
+    Static registry of the available device wrappers. The device wrapper
+    framework reads this list instead of importing every module in this
+    folder, so a wrapper module is only loaded once a device matches its
+    requirements.
+
+    Every entry is a tuple of:
+    - module name inside this folder
+    - wrapper class name
+    - names of the v4l2 capability flags the device must report
+    - keywords that must be passed to create_device_wrapper
+
+    New wrappers have to be added here to be picked up by create_device_wrapper
+'''
+
+WRAPPER_MANIFEST = (
+    ('v4l2_device_Base', 'v4l2DeviceBase', (), ()),
+    ('v4l2_device_RWCapability', 'v4l2DeviceRWCap', ('V4L2_CAP_READWRITE',), ()),
+    ('v4l2_device_Event', 'v4l2DeviceEvents', (), ()),
+    ('v4l2_device_DynamicControls', 'v4l2DeviceDynamicControls', (), ()),
+    ('v4l2_device_Hyperspectral', 'v4l2DeviceHyperspectral', (), ()),
+    ('v4l2_device_Crop', 'v4l2DeviceCrop', (), ()),
+    ('v4l2_device_Xform', 'v4l2DeviceXform', (), ('XFormGainDevice', 'XFormDistDevice')),
+    ('v4l2_device_Buffer', 'v4l2DeviceBuffer', ('V4L2_CAP_STREAMING', 'V4L2_CAP_VIDEO_CAPTURE'), ()),
+    ('v4l2_device_Stream', 'v4l2DeviceStream', ('V4L2_CAP_STREAMING',), ()),
+    ('v4l2_device_StreamEvents', 'v4l2DeviceStreamEvents', ('V4L2_CAP_STREAMING',), ()),
+    ('v4l2_device_HyperspectralStream', 'v4l2DeviceHyperspectralStream', ('V4L2_CAP_STREAMING',), ()),
+    ('v4l2_device_CropStream', 'v4l2DeviceCropStream', ('V4L2_CAP_STREAMING',), ()),
+)
@@ -0,0 +1,99 @@
+''' rolling frame timing statistics
+    does not work with device wrapper, used by
+    the stream wrapper to time dequeued frames
+'''
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+DEFAULT_WINDOW = 1024
+
+#upper edges in microseconds of the dequeue latency histogram bins
+LATENCY_BINS_US = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+
+class FrameTiming(object):
+    """rolling inter-frame interval and dequeue latency statistics"""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        super(FrameTiming, self).__init__()
+        self.window = window
+        #ring arrays, in nanoseconds
+        self._intervals = np.zeros(window, dtype=np.int64)
+        self._latencies = np.zeros(window, dtype=np.int64)
+        self._edges = np.array((0,) + LATENCY_BINS_US + (np.iinfo(np.int64).max // 1000,),
+                               dtype=np.int64) * 1000
+        self.reset()
+
+    def reset(self):
+        '''forgets all recorded frames'''
+        self.frames = 0
+        self._last_timestamp = None
+        self._num_intervals = 0
+        self._num_latencies = 0
+
+    def restart(self):
+        '''keeps the samples but starts a new sequence of frames, the
+           interval to the next frame is not recorded'''
+        self._last_timestamp = None
+
+    def add(self, timestamp_ns, latency_ns=None):
+        '''records a frame with its driver timestamp. latency_ns is the
+           time from the driver timestamp until the frame was returned'''
+        self.frames += 1
+        if self._last_timestamp is not None:
+            self._intervals[self._num_intervals % self.window] = timestamp_ns - self._last_timestamp
+            self._num_intervals += 1
+        self._last_timestamp = timestamp_ns
+        if latency_ns is not None:
+            self._latencies[self._num_latencies % self.window] = latency_ns
+            self._num_latencies += 1
+
+    def intervals(self, last=None):
+        '''returns the recorded intervals in ns, oldest first.
+           last limits the result to the most recent intervals'''
+        return self._ordered(self._intervals, self._num_intervals, last)
+
+    def latencies(self, last=None):
+        '''returns the recorded dequeue latencies in ns, oldest first'''
+        return self._ordered(self._latencies, self._num_latencies, last)
+
+    def _ordered(self, ring, recorded, last):
+        count = min(recorded, self.window)
+        if last is not None:
+            count = min(count, last)
+        end = recorded % self.window
+        if count <= end:
+            return ring[end - count:end].copy()
+        return np.concatenate((ring[self.window - (count - end):], ring[:end]))
+
+    def stats(self):
+        '''returns a dict with the interval and latency statistics over the
+           window. Intervals and latencies are in microseconds'''
+        result = {'frames': self.frames,
+                  'window': min(self._num_intervals, self.window)}
+        intervals = self.intervals()
+        if len(intervals):
+            us = intervals / 1000.0
+            mean = float(us.mean())
+            p50, p99 = np.percentile(us, (50, 99)).tolist()
+            result.update({'interval_mean': mean,
+                           'interval_p50': p50,
+                           'interval_p99': p99,
+                           'interval_max': float(us.max()),
+                           'jitter': float(us.std()),
+                           'fps': 1000000.0 / mean if mean > 0 else 0.0})
+        latencies = self.latencies()
+        if len(latencies):
+            us = latencies / 1000.0
+            p50, p99 = np.percentile(us, (50, 99)).tolist()
+            counts = np.histogram(latencies, self._edges)[0]
+            result.update({'latency_mean': float(us.mean()),
+                           'latency_p50': p50,
+                           'latency_p99': p99,
+                           'latency_max': float(us.max()),
+                           'latency_histogram': list(zip(LATENCY_BINS_US + (None,),
+                                                         counts.tolist()))})
+        return result
@@ -0,0 +1,200 @@
+''' per stage timing of the capture paths
+    does not work with device wrapper, used by
+    the base wrapper when instrumentation is enabled
+'''
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import os, sys
+import numpy as np
+
+try:
+    from time import perf_counter_ns
+except ImportError:
+    try:
+        #python < 3.7, same clock in float seconds
+        from time import perf_counter as _time
+    except ImportError:
+        #python 2 has no monotonic clock
+        from time import time as _time
+    def perf_counter_ns():
+        return int(_time() * 1e9)
+
+#log2 histogram buckets, bucket n holds durations below 2**n ns
+HISTOGRAM_BUCKETS = 40
+#buckets exported to Prometheus, about 1us to 34s
+PROMETHEUS_BUCKETS = range(10, 36)
+
+def no_timestamp():
+    '''used in place of perf_counter_ns when instrumentation is disabled'''
+    return 0
+
+def no_stage(stage, start):
+    '''used in place of StageTimer.record when instrumentation is disabled'''
+    return 0
+
+
+class StageTimer(object):
+    """aggregates stage durations into log2 histograms"""
+
+    def __init__(self):
+        super(StageTimer, self).__init__()
+        self._stages = {}
+
+    def reset(self):
+        self._stages.clear()
+
+    def record(self, stage, start):
+        '''records the time passed since start (a perf_counter_ns value)
+           for stage. Returns the current time so consecutive stages can
+           be chained'''
+        now = perf_counter_ns()
+        elapsed = now - start
+        entry = self._stages.get(stage)
+        if entry is None:
+            entry = self._stages[stage] = [0, 0, 0, np.zeros(HISTOGRAM_BUCKETS, dtype=np.int64)]
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+        entry[3][min(elapsed.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        return now
+
+    def snapshot(self):
+        '''returns a dict stage -> dict with count, total, mean, max and
+           approximate p50/p99 (upper bucket bound), in microseconds,
+           plus the raw log2 histogram'''
+        result = {}
+        for stage, (count, total, maximum, hist) in self._stages.items():
+            cumulative = np.cumsum(hist)
+            result[stage] = {
+                'count': count,
+                'total_us': total / 1000.0,
+                'mean_us': total / 1000.0 / count,
+                'max_us': maximum / 1000.0,
+                'p50_us': _bucket_bound(cumulative, count * 0.5),
+                'p99_us': _bucket_bound(cumulative, count * 0.99),
+                'histogram': hist.tolist(),
+            }
+        return result
+
+def _bucket_bound(cumulative, rank):
+    bucket = int(np.searchsorted(cumulative, rank))
+    return (1 << bucket) / 1000.0
+
+
+def prometheus_text(stats, prefix='v4l2wrapper'):
+    '''formats a stats() snapshot in the Prometheus text format. Stages
+       become histograms, other numeric values gauges'''
+    lines = []
+    stages = stats.get('stages', {})
+    if stages:
+        name = '{}_stage_seconds'.format(prefix)
+        lines.append('# TYPE {} histogram'.format(name))
+        for stage, entry in sorted(stages.items()):
+            cumulative = np.cumsum(entry['histogram'])
+            for bucket in PROMETHEUS_BUCKETS:
+                lines.append('{}_bucket{{stage="{}",le="{:.9g}"}} {}'.format(
+                    name, stage, (1 << bucket) / 1e9, cumulative[bucket]))
+            lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(name, stage, entry['count']))
+            lines.append('{}_sum{{stage="{}"}} {:.9g}'.format(name, stage, entry['total_us'] / 1e6))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, entry['count']))
+    for group, values in sorted(stats.items()):
+        if group == 'stages' or not isinstance(values, dict):
+            continue
+        for key, value in sorted(values.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = '{}_{}_{}'.format(prefix, group, key)
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {:.9g}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path, stats, prefix='v4l2wrapper'):
+    '''writes stats to path for the node exporter textfile collector.
+       The file is replaced atomically so readers never see partial data'''
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text(stats, prefix))
+    os.rename(tmp, path)
+
+
+_ioctl_names = None
+_ioc_dirs = {0: 'NONE', 1: 'W', 2: 'R', 3: 'RW'}
+
+def ioctl_name(op_code):
+    '''returns the VIDIOC_* name of an ioctl number. Numbers that are not
+       in the v4l2 module are decoded from their _IOC fields'''
+    global _ioctl_names
+    if _ioctl_names is None:
+        import v4l2
+        _ioctl_names = {}
+        for name in dir(v4l2):
+            value = getattr(v4l2, name)
+            if name.startswith('VIDIOC_') and isinstance(value, int):
+                _ioctl_names.setdefault(value & 0xffffffff, name)
+    op_code &= 0xffffffff
+    name = _ioctl_names.get(op_code)
+    if name is None:
+        name = "_IOC({},'{}',{},{})".format(_ioc_dirs[op_code >> 30],
+            chr((op_code >> 8) & 0xff), op_code & 0xff, (op_code >> 16) & 0x3fff)
+        _ioctl_names[op_code] = name
+    return name
+
+
+class IoctlTrace(object):
+    """aggregates count, time, errors and callers per ioctl"""
+
+    def __init__(self):
+        super(IoctlTrace, self).__init__()
+        #ioctl name -> [count, total ns, errors, {caller: count}]
+        self.ioctls = {}
+
+    def wrap(self, set_ioctl):
+        '''returns set_ioctl wrapped to record every call'''
+        def traced_set_ioctl(op_code, val):
+            caller = sys._getframe(1)
+            error = None
+            start = perf_counter_ns()
+            try:
+                return set_ioctl(op_code, val)
+            except Exception as e:
+                error = getattr(e, 'errno', None) or -1
+                raise
+            finally:
+                self.record(op_code, perf_counter_ns() - start, error,
+                            '{}:{}'.format(os.path.basename(caller.f_code.co_filename),
+                                           caller.f_code.co_name))
+        return traced_set_ioctl
+
+    def record(self, op_code, elapsed, error, caller):
+        name = ioctl_name(op_code)
+        entry = self.ioctls.get(name)
+        if entry is None:
+            entry = self.ioctls[name] = [0, 0, 0, {}]
+        entry[0] += 1
+        entry[1] += elapsed
+        if error is not None:
+            entry[2] += 1
+        entry[3][caller] = entry[3].get(caller, 0) + 1
+
+    def summary(self):
+        '''returns a list of (name, count, total us, errors, callers) sorted
+           by total time, callers sorted by number of calls'''
+        result = []
+        for name, (count, total, errors, callers) in self.ioctls.items():
+            result.append((name, count, total / 1000.0, errors,
+                           sorted(callers.items(), key=lambda c: -c[1])))
+        result.sort(key=lambda entry: -entry[2])
+        return result
+
+    def report(self, top=10, outp=sys.stdout):
+        '''prints the top ioctls by total time'''
+        summary = self.summary()
+        print('{:<32} {:>8} {:>12} {:>10} {:>6}  {}'.format(
+            'ioctl', 'calls', 'total us', 'mean us', 'errors', 'top caller'), file=outp)
+        for name, count, total, errors, callers in summary[:top]:
+            print('{:<32} {:>8} {:>12.1f} {:>10.1f} {:>6}  {} ({})'.format(
+                name, count, total, total / count, errors, callers[0][0], callers[0][1]), file=outp)
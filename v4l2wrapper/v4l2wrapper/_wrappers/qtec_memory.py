@@ -10,8 +10,9 @@
 # @Last Modified by:   Dimitrios Katsaros
 # @Last Modified time: 2016-11-28 14:56:43
 
-import mmap
+import mmap, os, stat
 import ctypes as ct
+from bisect import bisect
 
 MEM_FILE = '/dev/qtec_mem'
 MAX_MEM = 8000000 #8 MB
@@ -24,33 +25,98 @@ class qtec_mem_error(Exception):
 
 
 class qtec_memory(object):
-    """wrapper for Qtec memory"""
+    """wrapper for Qtec memory
 
+    Maps size bytes of mem_file once and hands out page aligned buffers
+    from it. Released buffers go back to a free list and are merged with
+    free neighbours, so the memory is reused across buffer reallocations.
+    A regular file of at least size bytes can stand in for the device
+    """
 
-    def __init__(self):
+    def __init__(self, mem_file=MEM_FILE, size=MAX_MEM):
         super(qtec_memory, self).__init__()
 
-        self._fd = open(MEM_FILE, 'r+w+b')
-        self._reserved_size = 0
-        self._mmap_list = []
-
+        if size < mmap.PAGESIZE:
+            raise qtec_mem_error('size {} is smaller than a page ({} bytes)'.format(size, mmap.PAGESIZE))
+        self._fd = open(mem_file, 'r+b')
+        self.size = size - size % mmap.PAGESIZE
+        st = os.fstat(self._fd.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size < self.size:
+            self._fd.close()
+            raise qtec_mem_error('{} is smaller than {} bytes'.format(mem_file, self.size))
+        self._mmap = mmap.mmap(self._fd.fileno(), self.size, flags=mmap.MAP_SHARED,
+            prot=(mmap.PROT_READ | mmap.PROT_WRITE), offset=0)
+        #free blocks as sorted lists of offsets and lengths
+        self._free_offsets = [0]
+        self._free_lengths = [self.size]
+        #buffer address -> (offset, length) of the allocated block
+        self._allocated = {}
+        self._used = 0
+        self._peak = 0
 
     def get_next_memory_frame(self, size):
         '''returns a ctypes char array mapped to qtec memory
            size is the size in bytes of the buffer'''
 
-        if size + self._reserved_size > MAX_MEM:
+        length = -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+        #first fit
+        for (i, free) in enumerate(self._free_lengths):
+            if free >= length:
+                break
+        else:
             raise qtec_mem_error('Not enough memory left')
+        offset = self._free_offsets[i]
+        if free == length:
+            del self._free_offsets[i]
+            del self._free_lengths[i]
+        else:
+            self._free_offsets[i] += length
+            self._free_lengths[i] -= length
+
+        buff = (ct.c_char * size).from_buffer(self._mmap, offset)
+        self._allocated[ct.addressof(buff)] = (offset, length)
+        self._used += length
+        self._peak = max(self._peak, self._used)
+        return buff
+
+    def release(self, buff):
+        '''returns a buffer from get_next_memory_frame to the free list.
+           The buffer must not be used by the device anymore'''
+        block = self._allocated.pop(ct.addressof(buff), None)
+        if block is None:
+            raise qtec_mem_error('Buffer was not allocated from this memory')
+        (offset, length) = block
+        self._used -= length
+        i = bisect(self._free_offsets, offset)
+        #merge with the following and the preceding free block
+        if i < len(self._free_offsets) and offset + length == self._free_offsets[i]:
+            length += self._free_lengths[i]
+            del self._free_offsets[i]
+            del self._free_lengths[i]
+        if i > 0 and self._free_offsets[i - 1] + self._free_lengths[i - 1] == offset:
+            self._free_lengths[i - 1] += length
+        else:
+            self._free_offsets.insert(i, offset)
+            self._free_lengths.insert(i, length)
 
-        buff = ct.c_char * size
-        #print size, self._reserved_size
-        mm = mmap.mmap(self._fd.fileno(), size, flags=mmap.MAP_SHARED,
-            prot=(mmap.PROT_READ | mmap.PROT_WRITE), offset=self._reserved_size)
-        pageno = 1
-        while mmap.PAGESIZE * pageno < size:
-            pageno += 1
-        self._reserved_size += mmap.PAGESIZE * pageno
-        self._mmap_list.append(mm)
-        return buff.from_buffer(mm)
+    def owns(self, buff):
+        '''True if buff is allocated from this memory'''
+        return ct.addressof(buff) in self._allocated
 
+    def stats(self):
+        '''returns a dict with the memory usage in bytes'''
+        return {'size': self.size,
+                'used': self._used,
+                'free': self.size - self._used,
+                'peak_used': self._peak,
+                'largest_free': max(self._free_lengths) if self._free_lengths else 0,
+                'allocations': len(self._allocated),
+                'free_blocks': len(self._free_offsets)}
 
+    def close(self):
+        '''unmaps the memory, all buffers have to be released and
+           dropped first'''
+        if self._allocated:
+            raise qtec_mem_error('{} buffers still allocated'.format(len(self._allocated)))
+        self._mmap.close()
+        self._fd.close()
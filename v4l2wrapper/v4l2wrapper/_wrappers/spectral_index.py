@@ -0,0 +1,187 @@
+''' spectral index expressions over hyperspectral cubes
+    does not work with device wrapper, used by
+    the hyperspectral wrapper to compute indexes
+'''
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import ast, re
+import numpy as np
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    #python 2 without the futures backport, indexes run in one thread
+    ThreadPoolExecutor = None
+
+_band_name = re.compile(r'^b(\d+)$')
+
+_binary_ops = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power,
+}
+
+_unary_ops = {
+    ast.USub: np.negative,
+}
+
+_number_nodes = (ast.Constant,) if hasattr(ast, 'Constant') else (ast.Num,)
+
+_functions = {
+    'abs': np.absolute,
+    'sqrt': np.sqrt,
+    'log': np.log,
+    'exp': np.exp,
+}
+
+class SpectralIndexError(Exception):
+    def __init__(self, value):
+        self.parameter = value
+    def __str__(self):
+        return repr(self.parameter)
+
+
+class SpectralIndex(object):
+    """an index expression compiled to a list of float32 ufunc calls
+
+    Bands are written as b<wavelength>, e.g. '(b843-b664)/(b843+b664)'.
+    Supported are + - * / **, unary minus, numbers and the functions
+    abs, sqrt, log and exp. Divisions by zero give inf or nan
+    """
+
+    def __init__(self, expression, wavelengths):
+        super(SpectralIndex, self).__init__()
+        self.expression = expression
+        #wavelength -> first plane of the cube holding it
+        self._planes = {}
+        for (plane, wavelength) in enumerate(np.asarray(wavelengths).tolist()):
+            self._planes.setdefault(int(wavelength), plane)
+        #instructions (ufunc, operands, destination), operands and destinations
+        #are ('band', plane), ('const', value) or ('tmp', register)
+        self._program = []
+        self._free = []
+        self._registers = 0
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as e:
+            raise SpectralIndexError('Invalid index expression {}: {}'.format(expression, e))
+        self._result = self._compile(tree.body)
+        self.bands = sorted(set(operand[1] for (ufunc, operands, dst) in self._program
+                                for operand in operands if operand[0] == 'band'))
+        #temporaries by (shape, thread slot)
+        self._temporaries = {}
+        #thread pool of evaluate, created on first use
+        self._pool = None
+        self._pool_workers = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''shuts down the thread pool used by evaluate'''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            self._pool_workers = 0
+
+    def _compile(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in _binary_ops:
+            operands = (self._compile(node.left), self._compile(node.right))
+            return self._emit(_binary_ops[type(node.op)], operands)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return self._compile(node.operand)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _unary_ops:
+            return self._emit(_unary_ops[type(node.op)], (self._compile(node.operand),))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+                node.func.id in _functions and len(node.args) == 1 and not node.keywords):
+            return self._emit(_functions[node.func.id], (self._compile(node.args[0]),))
+        if isinstance(node, ast.Name):
+            match = _band_name.match(node.id)
+            if not match:
+                raise SpectralIndexError('Unknown name {} in {}'.format(node.id, self.expression))
+            wavelength = int(match.group(1))
+            if wavelength not in self._planes:
+                raise SpectralIndexError('Band {} is not part of the cube'.format(wavelength))
+            return ('band', self._planes[wavelength])
+        if isinstance(node, _number_nodes):
+            value = getattr(node, 'value', getattr(node, 'n', None))
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return ('const', float(value))
+        raise SpectralIndexError('Unsupported element {} in {}'.format(
+            type(node).__name__, self.expression))
+
+    def _emit(self, ufunc, operands):
+        #registers of the operands can be reused for the result
+        for operand in operands:
+            if operand[0] == 'tmp':
+                self._free.append(operand[1])
+        if self._free:
+            dst = ('tmp', self._free.pop())
+        else:
+            dst = ('tmp', self._registers)
+            self._registers += 1
+        self._program.append((ufunc, operands, dst))
+        return dst
+
+    def evaluate(self, cube, out=None, workers=None):
+        '''
+        evaluates the index on a (bands, height, width) cube and returns a
+        float32 (height, width) array. out may be preallocated. With workers
+        above 1 the rows are split in blocks evaluated in a thread pool,
+        which is kept until close() or a call with another workers count
+        '''
+        shape = cube.shape[1:]
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape:
+            raise SpectralIndexError('Index output has shape {}, expected {}'.format(out.shape, shape))
+        if (not workers or workers < 2 or shape[0] < workers or
+                ThreadPoolExecutor is None):
+            self._run(cube, out, 0)
+            return out
+
+        pool = self._thread_pool(workers)
+        edges = np.linspace(0, shape[0], workers + 1).astype(int)
+        jobs = [pool.submit(self._run, cube[:, start:end], out[start:end], slot)
+                for (slot, (start, end)) in enumerate(zip(edges[:-1], edges[1:]))]
+        for job in jobs:
+            job.result()
+        return out
+
+    def _thread_pool(self, workers):
+        if self._pool_workers != workers:
+            self.close()
+            self._pool = ThreadPoolExecutor(workers)
+            self._pool_workers = workers
+        return self._pool
+
+    def _run(self, cube, out, slot):
+        key = (cube.shape[1:], slot)
+        temporaries = self._temporaries.get(key)
+        if temporaries is None:
+            temporaries = self._temporaries[key] = [np.empty(cube.shape[1:], dtype=np.float32)
+                                                    for _ in range(self._registers)]
+        result = self._result
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for (ufunc, operands, dst) in self._program:
+                target = out if dst is result else temporaries[dst[1]]
+                args = [_operand(cube, temporaries, operand) for operand in operands]
+                ufunc(*args, out=target, dtype=np.float32)
+        if result[0] != 'tmp':
+            #the expression is a single band or number
+            out[...] = _operand(cube, temporaries, result)
+        return out
+
+def _operand(cube, temporaries, operand):
+    (kind, value) = operand
+    if kind == 'band':
+        return cube[value]
+    if kind == 'tmp':
+        return temporaries[value]
+    return value
@@ -15,8 +15,12 @@
 from __future__ import print_function
 import v4l2, fcntl, errno, logging, ctypes, sys, errno, os
 
+import numpy as np
 from copy import copy
 from numbers import Number
+from contextlib import contextmanager
+from v4l2wrapper._wrappers.profiling import (StageTimer, perf_counter_ns,
+    no_timestamp, no_stage, write_prometheus, IoctlTrace)
 
 LOGGING_LEVEL_FINE_GRAINED_DEBUG = 5
 logging.FINE_GRAINED_DEBUG = LOGGING_LEVEL_FINE_GRAINED_DEBUG
@@ -37,6 +41,29 @@ _v4l2_ctrl_id_to_name_map = {
     v4l2.V4L2_CTRL_TYPE_U32: "U32 Array"
 }
 
+#numpy types of unsigned array control elements, by element size
+_elem_dtypes = {
+    1: np.uint8,
+    2: np.uint16,
+    4: np.uint32,
+}
+
+#numpy types of integer array control elements, by element size
+_signed_elem_dtypes = {
+    1: np.int8,
+    2: np.int16,
+    4: np.int32,
+    8: np.int64,
+}
+
+def _elem_dtype(ctrl):
+    '''numpy type of the elements of an array control, None if not handled'''
+    if ctrl.type in (v4l2.V4L2_CTRL_TYPE_INTEGER, v4l2.V4L2_CTRL_TYPE_INTEGER64):
+        return _signed_elem_dtypes.get(ctrl.elem_size)
+    if ctrl.type == v4l2.V4L2_CTRL_TYPE_STRING:
+        return None
+    return _elem_dtypes.get(ctrl.elem_size)
+
 
 class DeviceError(Exception):
     def __init__(self, value):
@@ -65,6 +92,11 @@ class v4l2DeviceBase(object):
         self.format = formt
         self.capabilities = capabilities
         self._strmoff_force_fd_reset = False
+        self._fmt_cache = None
+        #stage timing hooks, swapped by enable_instrumentation
+        self._stage_timer = None
+        self._tstamp = no_timestamp
+        self._tstage = no_stage
 
         if kwargs and "loggerparent" in kwargs:
             self.logger = kwargs["loggerparent"].getChild(DEVICE_WRAPPER_NAME)
@@ -91,6 +123,9 @@ class v4l2DeviceBase(object):
             self._do_reset = kwargs["reset"]
         else:
             self._do_reset = False
+
+        if kwargs and kwargs.get("instrumentation"):
+            self.enable_instrumentation()
         #list of chain of classes comprising the wrapper, used for debug
         self.device_wrapper_list = []
 
@@ -155,7 +190,7 @@ class v4l2DeviceBase(object):
             except IOError as e:
                 # no more custom controls available on this device
                 assert e.errno == errno.EINVAL
-                raise StopIteration
+                return
             yield copy(queryctrl)
 
     def list_controls(self):
@@ -225,40 +260,52 @@ class v4l2DeviceBase(object):
 
     def reset_controls(self):
         '''
-        performs a full device control reset
+        performs a full device control reset.
+        The controls are queried again on every reset, since their flags
+        and the presets can change, then written with one
+        VIDIOC_S_EXT_CTRLS per control class
         '''
         self._stream_ioctl_off()
+        for (ctrl_class, items) in _group_by_class(self._control_reset_values(), lambda item: item[0]):
+            try:
+                self.set_ctrl_values(items)
+            except (IOError, DeviceError) as e:
+                #the whole class is rejected if one control fails, retry one by one
+                self.logger.log(LOGGING_LEVEL_FINE_GRAINED_DEBUG,
+                    'Reset of control class {} failed, resetting controls one by one: {}'.format(
+                        ctrl_class, str(e)))
+                for item in items:
+                    try:
+                        self.set_ctrl_values([item])
+                    except (IOError, DeviceError) as e:
+                        self.logger.warning('Reset of control {} failed: {}'.format(
+                            item[0].name.decode('UTF-8'), str(e)))
+
+    def _control_reset_values(self):
+        '''list of (control query structure, reset value) tuples for all
+        currently writable controls, presets take precedence over default values'''
+        values = []
         for ctrl in self.controls_iterator():
             if not self.ctrl_is_writable(ctrl):
                 continue
             elif ctrl.flags&v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD:
-                if ctrl.type == v4l2.V4L2_CTRL_TYPE_STRING:
-                    continue
-                qex = self.query_ext_ctrl(ctrl.id)
-                exctrl = self.get_ext_ctrl(ctrl.id)
-                if qex.type < v4l2.V4L2_CTRL_COMPOUND_TYPES:
-                    for i in range(qex.elems):
-                        if qex.elem_size == 4:
-                            exctrl.controls[0].p_u32[i] = qex.default_value
-                        elif qex.elem_size == 2:
-                            exctrl.controls[0].p_16[i] = qex.default_value
-                        elif qex.elem_size == 1:
-                            exctrl.controls[0].p_8[i] = qex.default_value
-                        else:
-                            ControlError('Cannot reset control with byte size {}'.format(self.elem_size))
-                    self.set_ext_ctrl(exctrl)
-                    continue
-                else:
-                    #compound control reset goes here
+                if (ctrl.type == v4l2.V4L2_CTRL_TYPE_STRING or
+                    ctrl.type >= v4l2.V4L2_CTRL_COMPOUND_TYPES or
+                    _elem_dtype(ctrl) is None):
+                    #string and compound control reset goes here
                     continue
+                values.append((ctrl, np.full(ctrl.elems, ctrl.default_value,
+                                             dtype=_elem_dtype(ctrl))))
+                continue
             elif (ctrl.type == v4l2.V4L2_CTRL_TYPE_BUTTON or
                  ctrl.type == v4l2.V4L2_CTRL_TYPE_CTRL_CLASS):
                 continue
-            #self.logger.debug('Resetting control: {}'.format(ctrl.name))
-            if self.v4l2_presets and ctrl.name.decode('UTF-8') in self.v4l2_presets:
-                self.set_ctrl(ctrl.id, self.v4l2_presets[ctrl.name.decode('UTF-8')])
+            name = ctrl.name.decode('UTF-8')
+            if self.v4l2_presets and name in self.v4l2_presets:
+                values.append((ctrl, self.v4l2_presets[name]))
             else:
-                self.set_ctrl(ctrl.id, ctrl.default_value)
+                values.append((ctrl, ctrl.default_value))
+        return values
 
     def menu_iterator(self, queryctrl):
         '''
@@ -290,7 +337,7 @@ class v4l2DeviceBase(object):
                 ret = self._set_ioctl(v4l2.VIDIOC_ENUM_FMT, fmtdesc)
             except IOError as e:
                 assert e.errno == errno.EINVAL
-                raise StopIteration
+                return
             yield copy(fmtdesc)
             fmtdesc.index += 1
 
@@ -305,6 +352,19 @@ class v4l2DeviceBase(object):
         self._set_ioctl(v4l2.VIDIOC_G_FMT, fmt)
         return fmt
 
+    def get_cached_fmt(self):
+        '''
+        returns the current format without querying the device, the
+        format is only read again after it was changed through the wrapper
+        or invalidate_fmt_cache() was called. Do not modify the result
+        '''
+        if self._fmt_cache is None:
+            self._fmt_cache = self.get_fmt()
+        return self._fmt_cache
+
+    def invalidate_fmt_cache(self):
+        self._fmt_cache = None
+
     def set_fmt(self, fmt, strmoff=False):
         '''
         sets the format,
@@ -312,7 +372,11 @@ class v4l2DeviceBase(object):
         '''
         if strmoff is True:
             self._stream_ioctl_off()
+        self.invalidate_fmt_cache()
         self._set_ioctl(v4l2.VIDIOC_S_FMT, fmt)
+        #the driver updates fmt with the format it applied. copy() can't
+        #handle the pointer in the format union, copy the raw structure
+        self._fmt_cache = v4l2.v4l2_format.from_buffer_copy(fmt)
         return fmt
 
     def try_fmt(self, fmt, strmoff=False):
@@ -328,6 +392,7 @@ class v4l2DeviceBase(object):
         '''
         if strmoff == True:
             self._stream_ioctl_off()
+        self.invalidate_fmt_cache()
         return self._set_ioctl(v4l2.VIDIOC_S_FMT, self.defaultformat)
 
     def set_fmt_size(self, width=None, height=None):
@@ -557,6 +622,42 @@ class v4l2DeviceBase(object):
            self._stream_ioctl_off()
         return self._set_ioctl(v4l2.VIDIOC_S_EXT_CTRLS, controls)
 
+    def get_ctrl_values(self, ctrls):
+        '''
+        reads several controls using the extended api, one VIDIOC_G_EXT_CTRLS
+        per control class.
+        ctrls is a list of control query structures (see list_controls),
+        returns a list with the value of each control, values of payload
+        controls are numpy arrays
+        '''
+        values = [None] * len(ctrls)
+        for (ctrl_class, items) in _group_by_class(enumerate(ctrls), lambda item: item[1]):
+            (array, payloads) = _ext_ctrl_array([(ctrl, None) for (i, ctrl) in items])
+            controls = v4l2.v4l2_ext_controls(ctrl_class=ctrl_class, count=len(items), controls=array)
+            self._set_ioctl(v4l2.VIDIOC_G_EXT_CTRLS, controls)
+            for (n, (i, ctrl)) in enumerate(items):
+                if ctrl.flags & v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD:
+                    values[i] = payloads[n]
+                elif ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER64:
+                    values[i] = array[n].value64
+                else:
+                    values[i] = array[n].value
+        return values
+
+    def set_ctrl_values(self, values, strmoff=False):
+        '''
+        sets several controls using the extended api, one VIDIOC_S_EXT_CTRLS
+        per control class.
+        values is a list of (control query structure, value) tuples, values of
+        payload controls are arrays with one entry per element
+        '''
+        if strmoff is True:
+           self._stream_ioctl_off()
+        for (ctrl_class, items) in _group_by_class(values, lambda item: item[0]):
+            (array, payloads) = _ext_ctrl_array(items)
+            controls = v4l2.v4l2_ext_controls(ctrl_class=ctrl_class, count=len(items), controls=array)
+            self.set_ext_ctrl(controls)
+
     def control_class_iterator(self, ctrl_class):
         '''
         iterator that can be used in 'for' loop to
@@ -571,10 +672,10 @@ class v4l2DeviceBase(object):
             except IOError as e:
                 # no more custom controls available on this device
                 assert e.errno == errno.EINVAL
-                raise StopIteration
+                return
 
             if v4l2.V4L2_CTRL_ID2CLASS(queryctrl.id) != ctrl_class:
-                raise StopIteration
+                return
 
             yield copy(queryctrl)
 
@@ -634,6 +735,62 @@ class v4l2DeviceBase(object):
                 raise
         return controls
 
+    def enable_instrumentation(self):
+        '''
+        starts timing the stages of the capture paths (poll, dqbuf, copy,
+        decode, qbuf, ...). The timings are available through stats()
+        '''
+        if self._stage_timer is None:
+            self._stage_timer = StageTimer()
+        self._tstamp = perf_counter_ns
+        self._tstage = self._stage_timer.record
+
+    def disable_instrumentation(self):
+        '''
+        stops timing stages, the recorded timings are dropped
+        '''
+        self._stage_timer = None
+        self._tstamp = no_timestamp
+        self._tstage = no_stage
+
+    def stats(self):
+        '''
+        returns a snapshot of the wrapper statistics as a dict of dicts.
+        'stages' holds the stage timings when instrumentation is enabled
+        '''
+        if self._stage_timer is None:
+            return {}
+        return {'stages': self._stage_timer.snapshot()}
+
+    def write_stats(self, path, prefix=DEVICE_WRAPPER_NAME):
+        '''
+        writes stats() to path in the Prometheus text format, for the
+        node exporter textfile collector
+        '''
+        write_prometheus(path, self.stats(), prefix)
+
+    @contextmanager
+    def trace_ioctls(self, top=10, outp=sys.stdout):
+        '''
+        records every ioctl made by the wrapper within the with block:
+            with dev.trace_ioctls() as trace:
+                ...
+        and prints the top ioctls by total time on exit. Set top to 0 to
+        skip the report, the IoctlTrace holds the results
+        '''
+        trace = IoctlTrace()
+        previous = self.__dict__.get('_set_ioctl')
+        self._set_ioctl = trace.wrap(self._set_ioctl)
+        try:
+            yield trace
+        finally:
+            if previous is None:
+                del self._set_ioctl
+            else:
+                self._set_ioctl = previous
+            if top:
+                trace.report(top, outp)
+
 def _handle_compound_ctrls(qry, ext_ctrl):
     '''Internal handle for compound controls,
        this gets expanded as new controls are added
@@ -643,4 +800,39 @@ def _handle_compound_ctrls(qry, ext_ctrl):
         ext_ctrl.p_point = v4l2.v4l2_point()
     else:
         DeviceError('Unhandled compound type with id {}'
-            'for control {}'.format(qry.type, qry.name))
\ No newline at end of file
+            'for control {}'.format(qry.type, qry.name))
+
+def _group_by_class(items, get_ctrl):
+    '''groups items by the control class of their control, sorted by class'''
+    classes = {}
+    for item in items:
+        classes.setdefault(v4l2.V4L2_CTRL_ID2CLASS(get_ctrl(item).id), []).append(item)
+    return sorted(classes.items())
+
+def _ext_ctrl_array(values):
+    '''builds a v4l2_ext_control array from (query structure, value) tuples.
+       Payload controls point to numpy buffers, which are returned alongside
+       the array and have to be kept alive while it is used. A value of None
+       leaves the control empty, used for reads'''
+    array = (v4l2.v4l2_ext_control*len(values))()
+    payloads = []
+    for (i, (ctrl, value)) in enumerate(values):
+        array[i].id = ctrl.id
+        if ctrl.flags & v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD:
+            dtype = _elem_dtype(ctrl)
+            if dtype is None:
+                raise ExtCtrlError('Cannot handle payload of control {}'.format(ctrl.name))
+            if value is None:
+                payload = np.zeros(ctrl.elems, dtype=dtype)
+            else:
+                payload = np.ascontiguousarray(value, dtype=dtype).ravel()
+            array[i].size = payload.nbytes
+            array[i].ptr = payload.ctypes.data
+            payloads.append(payload)
+        else:
+            if ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER64:
+                array[i].value64 = value or 0
+            else:
+                array[i].value = value or 0
+            payloads.append(None)
+    return array, payloads
@@ -21,10 +21,10 @@ import v4l2
 from v4l2wrapper._wrappers.v4l2_device_Base import (v4l2DeviceBase,
     DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
 import numpy as np
-import copy
 import logging
 import ctypes as ct
-import errno
+import errno, os, select
+from collections import deque
 from builtins import range
 
 try:
@@ -41,6 +41,58 @@ except ImportError as e:
 #for now refraining from adding it.
 _supportedBuffers = [v4l2.V4L2_MEMORY_MMAP, v4l2.V4L2_MEMORY_USERPTR]
 
+try:
+    from time import monotonic_ns
+except ImportError:
+    try:
+        #python < 3.7, same clock in float seconds
+        from time import monotonic as _time
+    except ImportError:
+        #python 2 has no monotonic clock
+        from time import time as _time
+    def monotonic_ns():
+        return int(_time() * 1e9)
+
+#FrameInfo clock sources
+CLOCK_UNKNOWN = 'unknown'
+CLOCK_MONOTONIC = 'monotonic'
+CLOCK_COPY = 'copy'
+#timestamp moved onto the monotonic_ns() time base by the wrapper
+CLOCK_MAPPED = 'mapped'
+
+_timestamp_clocks = {
+    v4l2.V4L2_BUF_FLAG_TIMESTAMP_UNKNOWN: CLOCK_UNKNOWN,
+    v4l2.V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC: CLOCK_MONOTONIC,
+    v4l2.V4L2_BUF_FLAG_TIMESTAMP_COPY: CLOCK_COPY,
+}
+
+class FrameInfo(object):
+    '''
+    Metadata of a dequeued buffer, copied from the v4l2_buffer
+    used for VIDIOC_DQBUF. timestamp_ns is the driver timestamp
+    in nanoseconds, clock tells which clock it was taken from.
+    Timestamps with a monotonic or mapped clock can be compared
+    with monotonic_ns()
+    '''
+    __slots__ = ('index', 'sequence', 'bytesused', 'flags', 'field',
+                 'timestamp_ns', 'clock', 'exposure_ns')
+
+    def __init__(self, buf):
+        self.index = buf.index
+        self.sequence = buf.sequence
+        self.bytesused = buf.bytesused
+        self.flags = buf.flags
+        self.field = buf.field
+        self.timestamp_ns = (buf.timestamp.secs * 1000000 + buf.timestamp.usecs) * 1000
+        self.clock = _timestamp_clocks.get(buf.flags & v4l2.V4L2_BUF_FLAG_TIMESTAMP_MASK,
+                                           CLOCK_UNKNOWN)
+        #start of exposure on the monotonic_ns() time base, when the device reports it
+        self.exposure_ns = None
+
+    def __repr__(self):
+        return 'FrameInfo({})'.format(', '.join('{}={}'.format(name, getattr(self, name))
+                                                for name in self.__slots__))
+
 class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
 
     def __init__(self, tup):
@@ -49,12 +101,31 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
             raise DeviceError("DeviceBuffer: Attempted to wrap device that doesn't support buffering")
         elif not cap.capabilities & v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE:
             raise DeviceError("DeviceBuffer: Attempted to wrap device that doesn't support video capture")
+        kwargs = tup[3]
         super(v4l2DeviceBuffer, self).__init__(tup)
         self.device_wrapper_list.append('Buffer')
+        #map timestamps that are not monotonic onto monotonic_ns()
+        self.timestamp_monotonic = bool(kwargs and kwargs.get('timestamp_monotonic'))
+        self._timestamp_offset = None
+        #open the device with O_NONBLOCK and dequeue every ready buffer per wakeup
+        self.nonblocking = bool(kwargs and kwargs.get('nonblocking'))
+        self._epoll = None
+        #FrameInfo of buffers dequeued from the driver but not handed out yet
+        self._ready = deque()
         self.buffersrequested = False
         self.buffersqueued    = False
         self.buffers = []
+        #indexes of the buffers handed out and not yet requeued
         self.dequeued_buffers = []
+        self._decoder = None
+        #contiguous memory used for user pointers, created on first use
+        self._qtec_mem = None
+        #qtec_mem_file and qtec_mem_size select the memory device and its size
+        self._qtec_mem_args = {}
+        if kwargs and 'qtec_mem_file' in kwargs:
+            self._qtec_mem_args['mem_file'] = kwargs['qtec_mem_file']
+        if kwargs and 'qtec_mem_size' in kwargs:
+            self._qtec_mem_args['size'] = kwargs['qtec_mem_size']
 
     def cleanup(self):
         try:
@@ -70,7 +141,19 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
                     self.logger.log(LOGGING_LEVEL_FINE_GRAINED_DEBUG, 'Buffer: In cleanup: {}'.format(str(e)))
         except:
             pass
+        qtec_buffers = self._qtec_buffers()
         super(v4l2DeviceBuffer, self).cleanup()
+        if self._qtec_mem is not None:
+            #the fd is closed, the driver dropped its user pointers
+            try:
+                while qtec_buffers:
+                    self._qtec_mem.release(qtec_buffers.pop())
+                #the memory can only be unmapped once no buffer refers to it
+                del self.buffers[:]
+                self._qtec_mem.close()
+                self._qtec_mem = None
+            except Exception as e:
+                self.logger.log(LOGGING_LEVEL_FINE_GRAINED_DEBUG, 'Buffer: In cleanup: {}'.format(str(e)))
 
     def request_buffers(self, bufcount=2, bufmemory=v4l2.V4L2_MEMORY_MMAP): #, buftype=v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE, bufmemory=v4l2.V4L2_MEMORY_MMAP):
         '''
@@ -82,7 +165,10 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
         '''
         #perform cleanup if there are previous buffers
         self.cleanup_buffers()
-        self.open_fd()
+        if self.nonblocking:
+            self.open_fd(os.O_RDWR | os.O_NONBLOCK)
+        else:
+            self.open_fd()
 
         #first check if the memory type can be handled
         if bufmemory not in _supportedBuffers:
@@ -95,6 +181,11 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
             raise DeviceError("DeviceBuffer: Device does not support {}".format(str(bufmemory)))
         self.bufcount=reqbufs.count
         self._bufmemory=reqbufs.memory
+        #argument structures reused by every QBUF/DQBUF
+        self._qbuf = v4l2.v4l2_buffer(type=self.buftype, memory=self._bufmemory)
+        self._dqbuf = v4l2.v4l2_buffer(type=self.buftype, memory=self._bufmemory)
+        self._timestamp_offset = None
+        self._ready.clear()
         self.buffersrequested = True
 
     def cleanup_buffers(self):
@@ -103,14 +194,37 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
         for i in range(len(self.buffers)):
             try:
                 self.buffers[i].close()
-            except e:
+            except Exception as e:
                 self.logger.log(LOGGING_LEVEL_FINE_GRAINED_DEBUG, 'Buffer: In cleanup: {}'.format(str(e)))
+        qtec_buffers = self._qtec_buffers()
+        del self.buffers[:]
 
         reqbufs = v4l2.v4l2_requestbuffers(count=0,
             type=v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE, memory=self._bufmemory)
         res = self._set_ioctl(v4l2.VIDIOC_REQBUFS, reqbufs)
+        #the driver dropped its user pointers, the memory can be reused
+        for buff in qtec_buffers:
+            self._qtec_mem.release(buff)
+        self._queue_released()
+        self.buffersrequested = False
         self.close_fd()
 
+    def _queue_released(self):
+        '''
+        forgets the queue state once the driver gave every buffer back,
+        after STREAMOFF or freeing the buffers
+        '''
+        self.buffersqueued = False
+        del self.dequeued_buffers[:]
+        self._ready.clear()
+
+    def close_fd(self):
+        #the epoll registration belongs to the fd
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+        super(v4l2DeviceBuffer, self).close_fd()
+
     def enqueue_buffers(self):
         '''
         enqueues all buffers
@@ -132,7 +246,7 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
             buf.index = i
             if self._bufmemory == v4l2.V4L2_MEMORY_USERPTR:
                 buf.m.userptr = ct.addressof(self.buffers[i])
-                buf.length = self.format.fmt.pix.sizeimage
+                buf.length = ct.sizeof(self.buffers[i])
             ret = 0
             try:
                 ret = self._set_ioctl(v4l2.VIDIOC_QBUF, buf)
@@ -156,22 +270,43 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
     def _qtec_mem_enqueue(self):
         #first, try import
         try:
-            from qtec_memory import qtec_memory as qtmem
+            from v4l2wrapper._wrappers.qtec_memory import qtec_memory as qtmem
         except:
             return False
         buf = v4l2.v4l2_buffer(type=self.buftype, memory=self._bufmemory)
-        qt = qtmem()
+        if self._qtec_mem is None:
+            self._qtec_mem = qtmem(**self._qtec_mem_args)
+        qt = self._qtec_mem
+        #the buffers are all replaced, none is queued
+        for buff in self._qtec_buffers():
+            qt.release(buff)
+        sizeimage = self.get_cached_fmt().fmt.pix.sizeimage
         for i in range(self.bufcount):
-            self.buffers[i] = qt.get_next_memory_frame(self.format.fmt.pix.sizeimage)
+            self.buffers[i] = qt.get_next_memory_frame(sizeimage)
 
             buf.index = i
             buf.m.userptr = ct.addressof(self.buffers[i])
-            buf.length = self.format.fmt.pix.sizeimage
+            buf.length = sizeimage
             ret = self._set_ioctl(v4l2.VIDIOC_QBUF, buf)
 
             if ret != 0:
                 raise DeviceError("DeviceBuffer: Unable to enqbuf frame interval {}".format(i))
 
+    def _qtec_buffers(self):
+        '''returns the buffers allocated from qtec memory'''
+        if self._qtec_mem is None or self._bufmemory != v4l2.V4L2_MEMORY_USERPTR:
+            return []
+        return [buff for buff in self.buffers if self._qtec_mem.owns(buff)]
+
+    def qtec_memory_stats(self):
+        '''
+        returns the usage of the qtec contiguous memory, see
+        qtec_memory.stats, or None if it was not needed
+        '''
+        if self._qtec_mem is None:
+            return None
+        return self._qtec_mem.stats()
+
     def dequeue_buffers(self):
         '''
         dequeues all buffers
@@ -180,9 +315,9 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
         if not self.buffersqueued:
             raise DeviceError("DeviceBuffer: attempting to dequeue unqueued buffers")
         #Deque buffers
-        buf = v4l2.v4l2_buffer(type=self.buftype, memory=self._bufmemory, index=0)
-        for i in range(self.bufcount-len(self.dequeued_buffers)):
-            ret = self._set_ioctl(v4l2.VIDIOC_DQBUF, buf)
+        for i in range(self.bufcount-len(self.dequeued_buffers)-len(self._ready)):
+            ret = self._set_ioctl(v4l2.VIDIOC_DQBUF, self._dqbuf)
+        self._ready.clear()
 
         self.buffersqueued = False
 
@@ -202,15 +337,14 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
         '''
         if self._bufmemory != v4l2.V4L2_MEMORY_USERPTR:
             raise DeviceError('DeviceBuffer: Making a call to create user defined memory when set memory type is: {}'.format(self._bufmemory))
-        #reset the buffer list just in case
-        if not self.buffers:
-            for i in self.buffers:
-                if isinstance(i, mmap.mmap):
-                    i.close()
-                del i
-
+        sizeimage = self.get_cached_fmt().fmt.pix.sizeimage
+        #keep the buffers if they still fit the image
+        if (len(self.buffers) == self.bufcount and
+                all(ct.sizeof(i) >= sizeimage for i in self.buffers)):
+            return
+        del self.buffers[:]
         for i in range(self.bufcount):
-            buf = (ct.c_char*self.format.fmt.pix.sizeimage)()
+            buf = (ct.c_char*sizeimage)()
             self.buffers.append(buf)
 
     def init_memorymapping(self):
@@ -222,12 +356,13 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
             return False
         if self._bufmemory != v4l2.V4L2_MEMORY_MMAP:
             raise DeviceError('DeviceBuffer: Making a call to create memory mapping when set memory type is: {}'.format(self._bufmemory))
-	    #reset the buffer list just in case
-        if not self.buffers:
-            for i in self.buffers:
-                if isinstance(i, mmap.mmap):
-                    i.close()
-                del i
+        #the mappings stay valid until the buffers are freed, so they are
+        #reused when streaming restarts
+        if len(self.buffers) == self.bufcount:
+            return True
+        for i in self.buffers:
+            i.close()
+        del self.buffers[:]
         buf = v4l2.v4l2_buffer(type=self.buftype, memory=self._bufmemory)
 
         for i in range(self.bufcount):
@@ -236,74 +371,54 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
             self.buffers.append(mmap.mmap(self.fd, buf.length, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ | mmap.PROT_WRITE, offset=buf.m.offset))
         return True
 
-    def get_frame_info(self, requeue=True):
+    def get_frame_info(self, requeue=True, timeout=None):
         '''
         Dequeues an available buffer and returns the buffer information
 
         input:
         - requeue : determines if older buffers should be requeued, defaults to true
+        - timeout : seconds to wait for a buffer, None waits forever
 
         return value:
-        - v4l2_buffer
+        - FrameInfo, None on timeout
         '''
-
-        #call a requeue if there are dequeued buffers
-        if requeue and len(self.dequeued_buffers) > 0:
-            for i in range(len(self.dequeued_buffers)):
-                self._set_ioctl(v4l2.VIDIOC_QBUF, self.dequeued_buffers[i])
-            del self.dequeued_buffers[:]
-
-        buf = v4l2.v4l2_buffer(type=self.buftype, memory=self._bufmemory)
-        self._set_ioctl(v4l2.VIDIOC_DQBUF, buf)
-        self.dequeued_buffers.append(buf)
-
-        return copy.copy(buf)
+        return self._dequeue(requeue, timeout)
 
 
-    def get_frame(self, requeue=True):
+    def get_frame(self, requeue=True, timeout=None):
         '''
         Dequeues an available buffer and returns the buffer information and the memory mapping.
-        data is returned as raw byte data, stored in a string. Use get_fmt() to get a v4l2_format
-        with all formatting information
+        The mapping is reused by the device once the buffer is requeued. Use get_cached_fmt()
+        to get a v4l2_format with all formatting information
 
         input:
         - requeue : determines if older buffers should be requeued, defaults to true
+        - timeout : seconds to wait for a buffer, None waits forever
 
         return value:
-        - (v4l2_buffer, mmap_of_the_buffer)
+        - (FrameInfo, mmap_of_the_buffer), (None, None) on timeout
         '''
         if not self._MMAP_ENABLED:
             return None, None
         if len(self.buffers) == 0:
             raise DeviceError("DeviceBuffer: Attempting to get a frame when buffers have not been set")
 
-        #call a requeue if there are dequeued buffers
-        if requeue and len(self.dequeued_buffers) > 0:
-            for i in range(len(self.dequeued_buffers)):
-                self._set_ioctl(v4l2.VIDIOC_QBUF, self.dequeued_buffers[i])
-            del self.dequeued_buffers[:]
-
-        buf = v4l2.v4l2_buffer(type=self.buftype, memory=self._bufmemory)
-        self._set_ioctl(v4l2.VIDIOC_DQBUF, buf)
-        self.dequeued_buffers.append(buf)
-        if self._bufmemory != v4l2.V4L2_MEMORY_MMAP:
-            data = self.buffers[buf.index].read(buf.length)
-            self.buffers[buf.index].seek(0)
-        elif self._bufmemory != v4l2.V4L2_MEMORY_USERPTR:
-            data = self.buffers[buf.index]
-
-        return copy.copy(buf), data
+        info = self._dequeue(requeue, timeout)
+        if info is None:
+            return None, None
+        return info, self.buffers[info.index]
 
-    def get_formatted_frame(self, requeue=True):
+    def get_formatted_frame(self, requeue=True, timeout=None):
         '''
         Dequeues an available buffer and returns the memory mapping.
         Formats the mapping into a numpy array with the correct formatting.
 
         input:
         - requeue : determines if older buffers should be requeued, defaults to true
+        - timeout : seconds to wait for a buffer, None waits forever
 
         return value:
-        - np_array_with_formatted_data
+        - np_array_with_formatted_data, None on timeout
         '''
         if not self._MMAP_ENABLED:
             return None
@@ -311,76 +426,183 @@ class v4l2DeviceBuffer(__mmap_capable,v4l2DeviceBase):
         if len(self.buffers) == 0:
             raise DeviceError("DeviceBuffer: Attempting to get a frame when buffers have not been set")
 
-        #call a requeue if there are dequeued buffers
-        if requeue and len(self.dequeued_buffers) > 0:
-            for i in range(len(self.dequeued_buffers)):
-                self._set_ioctl(v4l2.VIDIOC_QBUF, self.dequeued_buffers[i])
-            del self.dequeued_buffers[:]
-        buf = v4l2.v4l2_buffer(type=self.buftype, memory=self._bufmemory, index=0)
-        self._set_ioctl(v4l2.VIDIOC_DQBUF, buf)
-        self.dequeued_buffers.append(buf)
+        info = self._dequeue(requeue, timeout)
+        if info is None:
+            return None
+        return self.format_frame(info)
 
-        if self._bufmemory == v4l2.V4L2_MEMORY_MMAP:
-            data = self.buffers[buf.index].read(buf.length)
-            self.buffers[buf.index].seek(0)
-        elif self._bufmemory == v4l2.V4L2_MEMORY_USERPTR:
-            data = self.buffers[buf.index]
+    def format_frame(self, info):
+        '''
+        Formats the buffer of a dequeued frame into a numpy array with the
+        correct formatting, like get_formatted_frame. The buffer must not
+        have been requeued yet.
 
+        input:
+        - info : FrameInfo returned by get_frame_info or get_frame
+
+        return value:
+        - np_array_with_formatted_data
+        '''
+        (fmt, pixformat, colors) = self._frame_decoder()
+        pix = fmt.fmt.pix
 
-        #format data using formatting information
+        #copy the data out of the buffer, it is overwritten once requeued
+        start = self._tstamp()
+        data = np.frombuffer(self.buffers[info.index], pixformat,
+                             count=pix.height * pix.width * colors).copy()
+        start = self._tstage('copy', start)
 
-        #ensure that data has been retrieved from the buffer
-        fmt = self.get_fmt()
-        if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y16:
-            pixformat = '>u2'
+        if colors == 1:
+            data = data.reshape((pix.height, pix.width))
         else:
-            pixformat = np.uint8
-
-        data = np.fromstring(data, pixformat)
-
-        if len(data) > 0:
-            if fmt.fmt.pix.pixelformat == v4l2.v4l2_fourcc('Q', '5', '4', '0'):
-                colors = 5
-            elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_RGB32 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR32:
-                colors = 4
-            elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_RGB24 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
-                colors = 3
-            elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
-                colors = 2
+            data = data.reshape((pix.height, pix.width, colors))
+
+        #if pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR32 or pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
+        #    data = data[:, :, [2, 1, 0]]
+
+        if pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV or pix.pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
+            data = data.reshape((pix.height, pix.width // 2, 4)).astype('int32')
+            rgb = np.empty((pix.height, pix.width // 2, 6))
+            if pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV:
+                y1 = data[:, :, 0]
+                y2 = data[:, :, 2]
+                u = data[:, :, 1]
+                v = data[:, :, 3]
             else:
-                colors = 1
+                y1 = data[:, :, 1]
+                y2 = data[:, :, 3]
+                v = data[:, :, 2]
+                u = data[:, :, 0]
+
+            rgb[:, :, 0] = (298 * (y1 - 16) + 409 * (v - 128) + 128) / 256
+            rgb[:, :, 1] = (298 * (y1 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
+            rgb[:, :, 2] = (298 * (y1 - 16) + 516 * (u - 128) + 128) / 256
+            rgb[:, :, 3] = (298 * (y2 - 16) + 409 * (v - 128) + 128) / 256
+            rgb[:, :, 4] = (298 * (y2 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
+            rgb[:, :, 5] = (298 * (y2 - 16) + 516 * (u - 128) + 128) / 256
+            rgb = np.clip(rgb, 0, 255)
+            data = rgb.reshape((pix.height, pix.width, 3)).astype('uint8')
+        self._tstage('decode', start)
+        return data
 
-            if colors == 1:
-                data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width))
+    def _dequeue(self, requeue=True, timeout=None):
+        '''
+        hands out the next filled buffer, requeueing the previously dequeued
+        buffers first if requeue is True. Returns a FrameInfo, or None if
+        no buffer was filled within timeout seconds
+        '''
+        if requeue and self.dequeued_buffers:
+            self._requeue_dequeued()
+        if not self._ready:
+            if timeout is None and not self.nonblocking:
+                self._dequeue_ready()
             else:
-                data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width, colors))
-
-            #if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR32 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
-            #    data = data[:, :, [2, 1, 0]]
-
-            if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
-                data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width / 2, 4)).astype('int32')
-                rgb = np.empty((fmt.fmt.pix.height, fmt.fmt.pix.width / 2, 6))
-                if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV:
-                    y1 = data[:, :, 0]
-                    y2 = data[:, :, 2]
-                    u = data[:, :, 1]
-                    v = data[:, :, 3]
-                else:
-                    y1 = data[:, :, 1]
-                    y2 = data[:, :, 3]
-                    v = data[:, :, 2]
-                    u = data[:, :, 0]
-
-                rgb[:, :, 0] = (298 * (y1 - 16) + 409 * (v - 128) + 128) / 256
-                rgb[:, :, 1] = (298 * (y1 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
-                rgb[:, :, 2] = (298 * (y1 - 16) + 516 * (u - 128) + 128) / 256
-                rgb[:, :, 3] = (298 * (y2 - 16) + 409 * (v - 128) + 128) / 256
-                rgb[:, :, 4] = (298 * (y2 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
-                rgb[:, :, 5] = (298 * (y2 - 16) + 516 * (u - 128) + 128) / 256
-                rgb = np.clip(rgb, 0, 255)
-                data = rgb.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width, 3)).astype('uint8')
-        return data
+                deadline = None if timeout is None else monotonic_ns() + int(timeout * 1e9)
+                while not self._ready:
+                    if not self._poll_ready(deadline):
+                        return None
+                    self._dequeue_ready()
+        info = self._ready.popleft()
+        self.dequeued_buffers.append(info.index)
+        self._frame_dequeued(info)
+        return info
+
+    def _poll_ready(self, deadline):
+        '''
+        waits until the fd is readable or the deadline (monotonic_ns) passes
+        '''
+        if self._epoll is None:
+            self._epoll = select.epoll()
+            self._epoll.register(self.fd, select.EPOLLIN)
+        if deadline is None:
+            timeout = -1
+        else:
+            timeout = max(deadline - monotonic_ns(), 0) / 1e9
+        start = self._tstamp()
+        while True:
+            try:
+                events = self._epoll.poll(timeout)
+                break
+            except (IOError, OSError) as e:
+                if e.errno != errno.EINTR:
+                    raise
+        self._tstage('poll', start)
+        return bool(events)
+
+    def _dequeue_ready(self):
+        '''
+        moves filled buffers from the driver to the ready queue. In non
+        blocking mode every ready buffer is dequeued, until EAGAIN
+        '''
+        buf = self._dqbuf
+        for _ in range(self.bufcount if self.nonblocking else 1):
+            start = self._tstamp()
+            try:
+                self._set_ioctl(v4l2.VIDIOC_DQBUF, buf)
+            except (IOError, OSError) as e:
+                if e.errno == errno.EAGAIN and self.nonblocking:
+                    break
+                raise
+            self._tstage('dqbuf', start)
+            info = FrameInfo(buf)
+            if self.timestamp_monotonic and info.clock != CLOCK_MONOTONIC:
+                self._map_timestamp(info, monotonic_ns())
+            self._ready.append(info)
+
+    def _frame_dequeued(self, info):
+        '''
+        called with the FrameInfo of every dequeued buffer, wrappers
+        override it to inspect frames as they arrive
+        '''
+        pass
 
+    def _map_timestamp(self, info, now):
+        '''
+        moves the timestamp onto the monotonic_ns() time base. The offset
+        between the clocks is the smallest one seen since buffers were
+        requested, i.e. the one from the frame dequeued with the least delay
+        '''
+        offset = now - info.timestamp_ns
+        if self._timestamp_offset is None or offset < self._timestamp_offset:
+            self._timestamp_offset = offset
+        info.timestamp_ns += self._timestamp_offset
+        info.clock = CLOCK_MAPPED
+
+    def _requeue_dequeued(self):
+        buf = self._qbuf
+        start = self._tstamp()
+        for index in self.dequeued_buffers:
+            buf.index = index
+            if self._bufmemory == v4l2.V4L2_MEMORY_USERPTR:
+                buf.m.userptr = ct.addressof(self.buffers[index])
+                buf.length = ct.sizeof(self.buffers[index])
+            self._set_ioctl(v4l2.VIDIOC_QBUF, buf)
+        self._tstage('qbuf', start)
+        del self.dequeued_buffers[:]
 
+    def _frame_decoder(self):
+        '''
+        returns (format, numpy type, colors) used to format frames.
+        Computed once per format, follows the cached format
+        '''
+        fmt = self.get_cached_fmt()
+        if self._decoder is not None and self._decoder[0] is fmt:
+            return self._decoder
+        pixelformat = fmt.fmt.pix.pixelformat
+        if pixelformat == v4l2.V4L2_PIX_FMT_Y16:
+            pixformat = '>u2'
+        else:
+            pixformat = np.uint8
 
+        if pixelformat == v4l2.v4l2_fourcc('Q', '5', '4', '0'):
+            colors = 5
+        elif pixelformat == v4l2.V4L2_PIX_FMT_RGB32 or pixelformat == v4l2.V4L2_PIX_FMT_BGR32:
+            colors = 4
+        elif pixelformat == v4l2.V4L2_PIX_FMT_RGB24 or pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
+            colors = 3
+        elif pixelformat == v4l2.V4L2_PIX_FMT_YUYV or pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
+            colors = 2
+        else:
+            colors = 1
+        self._decoder = (fmt, pixformat, colors)
+        return self._decoder
@@ -81,6 +81,8 @@ class v4l2DeviceCrop(v4l2DeviceBase):
     def set_selection(self, selection, strmoff=True):
         if strmoff is True:
             self._stream_ioctl_off()
+        #the image size follows the selection
+        self.invalidate_fmt_cache()
         return self._set_ioctl(v4l2.VIDIOC_S_SELECTION, selection)
 
     def set_crop_rect(self, width=None, height=None, top=None, left=None):
@@ -99,6 +101,34 @@ class v4l2DeviceCrop(v4l2DeviceBase):
         crop = self.get_crop()
         return (crop.r.left, crop.r.top, crop.r.width, crop.r.height)
 
+    def switch_roi(self, rect):
+        '''
+        crops to rect (left, top, width, height) with a single
+        VIDIOC_S_SELECTION, without reading the current crop first.
+        Returns the rectangle set, as adjusted by the driver
+        '''
+        return self._switch_selection(self._roi_selection([rect]))[0]
+
+    def switch_rois(self, rects):
+        '''
+        crops to several rectangles at once, for drivers supporting
+        multiple crop rectangles (v4l2_ext_rect). Returns the list of
+        rectangles set, as adjusted by the driver
+        '''
+        return self._switch_selection(self._roi_selection(rects))
+
+    def _switch_selection(self, selection):
+        self.set_selection(selection)
+        return _selection_rects(selection)
+
+    def _roi_selection(self, rects):
+        selection = v4l2.v4l2_selection(type=v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE,
+            target=v4l2.V4L2_SEL_TGT_CROP, r=v4l2.v4l2_rect(*rects[0]))
+        if len(rects) > 1:
+            selection.rectangles = len(rects)
+            selection.pr = (v4l2.v4l2_ext_rect * len(rects))(
+                *[v4l2.v4l2_ext_rect(r=v4l2.v4l2_rect(*rect)) for rect in rects])
+        return selection
 
     def center_img(self):
         crop = self.get_crop()
@@ -106,3 +136,11 @@ class v4l2DeviceCrop(v4l2DeviceBase):
         crop.r.left = abs((comp.r.width-crop.r.width)/2)
         crop.r.top = abs((comp.r.height-crop.r.height)/2)
         return self.set_selection(crop)
+
+def _selection_rects(selection):
+    '''returns the rectangles of a selection as (left, top, width, height)'''
+    if selection.rectangles > 1:
+        rects = [selection.pr[i].r for i in range(selection.rectangles)]
+    else:
+        rects = [selection.r]
+    return [(r.left, r.top, r.width, r.height) for r in rects]
@@ -0,0 +1,238 @@
+'''
+    Cropping while streaming
+
+    Switches the region of interest of a streaming device while keeping
+    its buffers, so a ROI change costs a STREAMOFF/STREAMON instead of
+    freeing, requesting and mapping the buffers again.
+    RoiScheduler captures several regions of interest round robin
+'''
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import v4l2
+from v4l2wrapper._wrappers.v4l2_device_Base import DeviceError
+from v4l2wrapper._wrappers.v4l2_device_Crop import v4l2DeviceCrop, _selection_rects
+from v4l2wrapper._wrappers.v4l2_device_Stream import v4l2DeviceStream
+import numpy as np
+import ctypes
+import errno
+
+class v4l2DeviceCropStream(v4l2DeviceCrop, v4l2DeviceStream):
+
+    def __init__(self, tup):
+        super(v4l2DeviceCropStream, self).__init__(tup)
+        self.device_wrapper_list.append('CropStream')
+
+    def _switch_selection(self, selection):
+        '''
+        While streaming, the buffers are kept if the new image fits in
+        them, otherwise they are requested again with the same count and
+        memory type. Frames dequeued afterwards follow the new format
+        '''
+        if not self.streaming:
+            return super(v4l2DeviceCropStream, self)._switch_selection(selection)
+
+        buffertype = ctypes.c_int(v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        self._set_ioctl(v4l2.VIDIOC_STREAMOFF, buffertype)
+        self._queue_released()
+        self.streaming = False
+
+        self.invalidate_fmt_cache()
+        try:
+            self._set_selection_busy(selection)
+        except Exception:
+            #keep streaming with the previous selection
+            self.stream_on()
+            raise
+
+        if (not self.buffersrequested or
+                self.get_cached_fmt().fmt.pix.sizeimage > self._buffer_capacity()):
+            self.logger.debug('CropStream: image does not fit the buffers, requesting new buffers')
+            self._realloc_for_roi()
+        if not self.stream_on():
+            raise DeviceError('CropStream: failed to restart streaming after switching roi')
+        return _selection_rects(selection)
+
+    def _set_selection_busy(self, selection):
+        try:
+            self._set_ioctl(v4l2.VIDIOC_S_SELECTION, selection)
+        except IOError as e:
+            #drivers may refuse size changes while buffers are allocated
+            if e.errno != errno.EBUSY:
+                raise
+            self.cleanup_buffers()
+            self.open_fd()
+            self._set_ioctl(v4l2.VIDIOC_S_SELECTION, selection)
+
+    def _realloc_for_roi(self):
+        self.request_buffers(self.bufcount, self._bufmemory)
+        if self._bufmemory == v4l2.V4L2_MEMORY_USERPTR:
+            self.init_userptr()
+
+    def _buffer_capacity(self):
+        '''returns the size of the smallest buffer, 0 if none are set up'''
+        if not self.buffers:
+            return 0
+        if self._bufmemory == v4l2.V4L2_MEMORY_MMAP:
+            return min(len(i) for i in self.buffers)
+        return min(ctypes.sizeof(i) for i in self.buffers)
+
+
+class RoiScheduler(object):
+    """captures frames round robin over regions of interest
+
+    rois is a list of rectangles (left, top, width, height), or of
+    (rectangle, overrides) tuples where overrides is a dict of control
+    name -> value applied while that region is captured. Controls that a
+    region does not override keep the value they had when the scheduler
+    was created.
+
+    If the driver accepts several crop rectangles (v4l2_ext_rect) and no
+    region overrides controls, all regions are set at once and every
+    frame is split into them. The frame is assumed to hold the regions
+    stacked from top to bottom in the given order, each left aligned.
+
+    With canvas True the regions are also copied into self.canvas, a
+    frame of the default crop size, assuming the regions are not scaled
+    """
+
+    def __init__(self, device, rois, canvas=False, multi_rect=True, settle=0):
+        super(RoiScheduler, self).__init__()
+        self.device = device
+        self.rois = []
+        ctrls = {}
+        for roi in rois:
+            if len(roi) == 2:
+                (rect, overrides) = roi
+            else:
+                (rect, overrides) = (roi, {})
+            values = []
+            for (name, value) in overrides.items():
+                ctrl = device.find_ctrl(name)
+                if ctrl is None:
+                    raise DeviceError('RoiScheduler: control {} not found'.format(name))
+                ctrls[ctrl.id] = ctrl
+                values.append((ctrl.id, value))
+            self.rois.append((tuple(rect), values))
+        self._ctrls = ctrls
+        #control values restored for regions that do not override them
+        ids = list(ctrls)
+        self._defaults = dict(zip(ids, device.get_ctrl_values([ctrls[i] for i in ids])))
+        self._current = dict(self._defaults)
+        #rectangles as adjusted by the driver, by region id
+        self.rects = [rect for (rect, values) in self.rois]
+        self._active_rect = None
+        self.multi_rect = multi_rect and len(self.rois) > 1 and not ctrls
+        self._multi_active = False
+        self.settle = settle
+        self.stitch = canvas
+        self.canvas = None
+
+    def frames(self, count=None, timeout=None):
+        '''
+        generator yielding (roi id, FrameInfo, data) for count frames,
+        forever if count is None. data is a numpy array that stays valid
+        after the next frame. Stops early if no frame arrives within
+        timeout seconds. The controls are restored once it finishes
+        '''
+        roi_id = 0
+        produced = 0
+        try:
+            while count is None or produced < count:
+                if self.multi_rect:
+                    frames = self._capture_multi(timeout)
+                if not self.multi_rect:
+                    frames = self._capture_roi(roi_id, timeout)
+                    roi_id = (roi_id + 1) % len(self.rois)
+                if frames is None:
+                    return
+                for frame in frames:
+                    if count is not None and produced >= count:
+                        return
+                    produced += 1
+                    yield frame
+        finally:
+            self.restore_controls()
+
+    def restore_controls(self):
+        '''sets the overridden controls back to their initial values'''
+        self._apply_controls([])
+
+    def _capture_roi(self, roi_id, timeout):
+        (rect, values) = self.rois[roi_id]
+        switched = self._apply_controls(values)
+        if rect != self._active_rect:
+            self.rects[roi_id] = self.device.switch_roi(rect)
+            self._active_rect = rect
+            self._multi_active = False
+            switched = True
+        info = self._next_frame(timeout, switched)
+        if info is None:
+            return None
+        data = self.device.format_frame(info)
+        self._stitch(roi_id, data)
+        return [(roi_id, info, data)]
+
+    def _capture_multi(self, timeout):
+        switched = not self._multi_active
+        if switched:
+            try:
+                rects = self.device.switch_rois([rect for (rect, values) in self.rois])
+            except IOError as e:
+                rects = None
+                self.device.logger.debug('RoiScheduler: switch_rois failed: {}'.format(str(e)))
+            #drivers unaware of multiple rectangles only apply the first one
+            pix = self.device.get_cached_fmt().fmt.pix
+            if (not rects or len(rects) != len(self.rois) or
+                    pix.height < sum(rect[3] for rect in rects) or
+                    pix.width < max(rect[2] for rect in rects)):
+                self.device.logger.debug('RoiScheduler: multiple rectangles not supported, '
+                                         'switching roi per frame')
+                self.multi_rect = False
+                return None
+            self.rects = rects
+            self._multi_active = True
+            self._active_rect = None
+        info = self._next_frame(timeout, switched)
+        if info is None:
+            return None
+        data = self.device.format_frame(info)
+        frames = []
+        line = 0
+        for (roi_id, (left, top, width, height)) in enumerate(self.rects):
+            part = data[line:line + height, :width]
+            line += height
+            self._stitch(roi_id, part)
+            frames.append((roi_id, info, part))
+        return frames
+
+    def _next_frame(self, timeout, switched):
+        #frames exposed before a switch took effect are skipped
+        for _ in range(self.settle + 1 if switched else 1):
+            info = self.device.get_frame_info(timeout=timeout)
+            if info is None:
+                return None
+        return info
+
+    def _apply_controls(self, values):
+        target = dict(self._defaults)
+        target.update(values)
+        changes = [(ctrl_id, value) for (ctrl_id, value) in target.items()
+                   if self._current.get(ctrl_id) != value]
+        if changes:
+            self.device.set_ctrl_values([(self._ctrls[ctrl_id], value)
+                                         for (ctrl_id, value) in changes])
+            self._current.update(changes)
+        return bool(changes)
+
+    def _stitch(self, roi_id, data):
+        if not self.stitch:
+            return
+        bounds = self.device.defaultcrop.r
+        if self.canvas is None or self.canvas.dtype != data.dtype:
+            self.canvas = np.zeros((bounds.height, bounds.width) + data.shape[2:],
+                                   dtype=data.dtype)
+        (left, top, width, height) = self.rects[roi_id]
+        (top, left) = (top - bounds.top, left - bounds.left)
+        self.canvas[top:top + data.shape[0], left:left + data.shape[1]] = data
@@ -17,8 +17,9 @@
 
 import v4l2
 import ctypes
+import numpy as np
 from v4l2wrapper._wrappers.v4l2_device_Base import (
-    v4l2DeviceBase, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
+    v4l2DeviceBase, DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG, _elem_dtype)
 import re
 import keyword, weakref
 
@@ -73,10 +74,8 @@ class BooleanControl(BaseControl):
 
     def __init__(self, queryctrl, wref):
         super(BooleanControl, self).__init__(queryctrl, wref)
-        self.val = 0
-        dev = self.wref()
-        if dev:
-            self.val = dev.get_ctrl(self.id)
+        #last value written through this control, None until used
+        self.val = None
 
     def turn_on(self):
         if self.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY:
@@ -97,7 +96,8 @@ class BooleanControl(BaseControl):
     def switch_val(self):
         dev = self.wref()
         if dev:
-            dev.set_ctrl(self.id, not self.val, strmoff=True)
+            self.val = int(not dev.get_ctrl(self.id))
+            dev.set_ctrl(self.id, self.val, strmoff=True)
 
 class ButtonControl(BaseControl):
 
@@ -110,38 +110,49 @@ class ButtonControl(BaseControl):
             dev.set_ctrl(self.id, 0, strmoff=True)
 
 class MenuControl(BaseControl):
+    '''
+    Menu items are only queried from the device the first time
+    they are needed
+    '''
 
     def __init__(self, queryctrl, wref):
         super(MenuControl, self).__init__(queryctrl, wref)
-
-        self.menuitems = []
-        def runfunc(weakref, menuid, menukey):
-            dev = weakref()
+        self._queryctrl = queryctrl
+        self._menuitems = None
+
+    @property
+    def menuitems(self):
+        '''list of (item name, select function) tuples'''
+        if self._menuitems is None:
+            dev = self.wref()
+            if not dev:
+                return []
+            self._menuitems = [(self._item_name(item), self._select_func(item.index))
+                               for item in dev.menu_iterator(self._queryctrl)]
+        return self._menuitems
+
+    def find_item(self, itmname):
+        for (name, func) in self.menuitems:
+            if name == itmname:
+                return func
+        return None
+
+    def _item_name(self, item):
+        return clean(item.name.decode('UTF-8'))
+
+    def _select_func(self, index):
+        wref = self.wref
+        ctrlid = self.id
+        def select():
+            dev = wref()
             if dev:
-                dev.set_ctrl(menuid, menukey, strmoff=True)
-        menufun = lambda wref, menuid, menukey: lambda: runfunc(wref, menuid, menukey)
-
-        dev = wref()
-        for item in dev.menu_iterator(queryctrl):
-            mname = clean(item.name.decode('UTF-8'))
-            self.menuitems.append((mname, menufun(wref, queryctrl.id, item.index)))
+                dev.set_ctrl(ctrlid, index, strmoff=True)
+        return select
 
-class IntegerMenuControl(BaseControl):
+class IntegerMenuControl(MenuControl):
 
-    def __init__(self, queryctrl, wref):
-        super(IntegerMenuControl, self).__init__(queryctrl, wref)
-
-        self.menuitems = []
-        def runfunc(weakref, menuid, menukey):
-            dev = weakref()
-            if dev:
-                dev.set_ctrl(menuid, menukey, strmoff=True)
-        menufun = lambda wref, menuid, menukey: lambda: runfunc(wref, menuid, menukey)
-
-        dev = wref()
-        for item in dev.menu_iterator(queryctrl):
-            mname = str(item.value)
-            self.menuitems.append((mname, menufun(wref, queryctrl.id, item.index)))
+    def _item_name(self, item):
+        return str(item.value)
 
 class IntegerControl(BaseControl):
 
@@ -229,87 +240,86 @@ class BaseExtCtrl(object):
         self.dims = queryctrl.dims
 
     def set_to_default(self):
-        if (  self.flags & v4l2.V4L2_CTRL_FLAG_DISABLED or
-              self.flags & v4l2.V4L2_CTRL_FLAG_INACTIVE or
-              self.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY or
-              self.type == v4l2.V4L2_CTRL_TYPE_STRING):
-            return
-        dev = self.wref()
-        if not dev:
-            return
-
-        ctrl = dev.get_ext_ctrl(self.id)
-
-        if self.type < v4l2.V4L2_CTRL_COMPOUND_TYPES:
-            for i in xrange(self.elems):
-                try:
-                    _write_to_array_pos(ctrl.controls[0], i, self.elem_size, self.default)
-                except ControlError:
-                    ControlError('Cannot reset control with byte size {}'.format(self.elem_size))
-            dev.set_ext_ctrl(ctrl)
-        else:
-            #compound resets should go here
-            pass
+        #string and compound resets should go here
+        raise ControlError('Resetting control {} of type {} to its default is not supported'.format(
+                                    self.name, self.type))
 
 class ArrayControl(BaseExtCtrl):
+    '''
+    Array controls are transfered as a whole, every read or write
+    of the payload is a single extended control ioctl. Values are
+    numpy arrays shaped by the control dimensions
+    '''
     def __init__(self, queryctrl, wref):
         super(ArrayControl, self).__init__(queryctrl, wref)
+        self.dtype = _elem_dtype(self)
+        if self.nr_of_dims:
+            self.shape = tuple(self.dims[:self.nr_of_dims])
+        else:
+            self.shape = (self.elems,)
 
     def __len__(self):
         return self.elems
 
     def __setitem__(self, index, value):
-
-        dev = self.wref()
-        if not dev:
-            return
-        if isinstance(index, tuple):
-            raise ControlError('multi-dimentional indexing not supported')
-        elif value < self.minimum or value > self.maximum:
-            raise ControlError('Value {} is not within the range [{}, {}] for control {}'.format(
-                                        value, self.minimum, self.maximum, self.name))
-        elif isinstance(index, int):
-            if index < 0 or index >= self.elems:
-                raise ControlError('Index {} is not within the range [{}, {}] for control {}'.format(
-                                        index, 0, self.elems, self.name))
-
-        ctrl = dev.get_ext_ctrl(self.id)
-        if ctrl.error_idx != 0:
-            raise ControlError('Exception raised from get control {}, error code {}'.format(
-                                        self.name, ctrl.error_idx))
-
-        if isinstance(index, slice):
-            if index.start == None and index.stop == None and index.step == None:
-                for i in xrange(self.elems):
-                    _write_to_array_pos(ctrl.controls[0], i, self.elem_size, value)
-            else:
-                raise ControlError('Index slicing not yet supported for Array Controls')
+        self._check_range(value)
+        if isinstance(index, slice) and index == slice(None):
+            array = np.empty(self.shape, dtype=self.dtype)
         else:
-            _write_to_array_pos(ctrl.controls[0], index, self.elem_size, value)
-
-        dev.set_ext_ctrl(ctrl)
+            array = self.read()
+        try:
+            array[index] = value
+        except IndexError as e:
+            raise ControlError('Index {} is not valid for control {} with shape {}: {}'.format(
+                                        index, self.name, self.shape, e))
+        self.write(array)
 
     def __getitem__(self, index):
+        array = self.read()
+        try:
+            return array[index]
+        except IndexError as e:
+            raise ControlError('Index {} is not valid for control {} with shape {}: {}'.format(
+                                        index, self.name, self.shape, e))
 
-        if isinstance(index, slice):
-            raise ControlError('Index slicing not yet supported for Array Controls')
-        elif isinstance(index, tuple):
-            raise ControlError('multi-dimentional indexing not supported')
-        elif not isinstance(index, int):
-            raise ControlError('Non integer indexing not supported')
-        elif index < 0 or index >= self.elems:
-            raise ControlError('Index {} is not within the range [{}, {}] for control {}'.format(
-                                        index, 0, self.elems, self.name))
+    def read(self):
+        '''reads the entire payload of the control, returns a numpy array'''
+        if self.flags & v4l2.V4L2_CTRL_FLAG_WRITE_ONLY:
+            raise ControlError('Attempted to read value from write only control {}'.format(
+                                        self.name))
         dev = self.wref()
         if not dev:
-            return 0
-        ctrl = dev.get_ext_ctrl(self.id)
-        if ctrl.error_idx != 0:
+            return None
+        array = np.empty(self.shape, dtype=self._payload_dtype())
+        ctrls = self._ext_ctrls(array)
+        dev._set_ioctl(v4l2.VIDIOC_G_EXT_CTRLS, ctrls)
+        if ctrls.error_idx != 0:
             raise ControlError('Exception raised from get control {}, error code {}'.format(
-                                        self.name, ctrl.error_idx))
+                                        self.name, ctrls.error_idx))
+        return array
 
-        return _get_from_array_pos(ctrl.controls[0], index, self.elem_size)
+    def write(self, array):
+        '''writes the entire payload of the control from an array like value
+        with the same number of elements as the control'''
+        if self.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY:
+            raise ControlError('Attempted to write to read only control {}'.format(self.name))
+        array = np.asarray(array)
+        if array.size != self.elems:
+            raise ControlError('Array of size {} does not match the {} elements of control {}'.format(
+                                        array.size, self.elems, self.name))
+        self._check_range(array)
+        array = np.ascontiguousarray(array, dtype=self._payload_dtype()).reshape(self.shape)
+        dev = self.wref()
+        if not dev:
+            return 0
+        return dev.set_ext_ctrl(self._ext_ctrls(array))
 
+    def set_to_default(self):
+        if (  self.flags & v4l2.V4L2_CTRL_FLAG_DISABLED or
+              self.flags & v4l2.V4L2_CTRL_FLAG_INACTIVE or
+              self.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY):
+            return
+        self.write(np.full(self.shape, self.default, dtype=self._payload_dtype()))
 
     def get_value(self):
         dev = self.wref()
@@ -324,28 +334,24 @@ class ArrayControl(BaseExtCtrl):
                                         self.name, ctrl.error_idx))
         return ctrl.controls[0]
 
-#helper functions for array types
-
-def _write_to_array_pos(array, index, elem_size, value):
-    if elem_size == 4:
-        array.p_u32[index] = value
-    elif elem_size == 2:
-        array.p_16[index] = value
-    elif elem_size == 1:
-        array.p_8[index] = value
-    else:
-        ControlError('Cannot handle control with byte size {}'.format(self.elem_size))
-
-def _get_from_array_pos(array, index, elem_size):
-    if elem_size == 4:
-        return array.p_u32[index]
-    elif elem_size == 2:
-        return array.p_16[index]
-    elif elem_size == 1:
-        return array.p_8[index]
-    else:
-        ControlError('Cannot handle control with byte size {}'.format(self.elem_size))
+    def _payload_dtype(self):
+        if self.dtype is None:
+            raise ControlError('Cannot handle control with byte size {}'.format(self.elem_size))
+        return self.dtype
+
+    def _check_range(self, value):
+        value = np.asarray(value)
+        if value.size and (value.min() < self.minimum or value.max() > self.maximum):
+            raise ControlError('Value {} is not within the range [{}, {}] for control {}'.format(
+                                        value, self.minimum, self.maximum, self.name))
 
+    def _ext_ctrls(self, array):
+        '''extended control structure pointing at the memory of array'''
+        ctrl = (v4l2.v4l2_ext_control*1)()
+        ctrl[0].id = self.id
+        ctrl[0].size = array.nbytes
+        ctrl[0].ptr = array.ctypes.data_as(ctypes.c_void_p)
+        return v4l2.v4l2_ext_controls(ctrl_class=0, count=1, controls=ctrl)
 
 class StringControl(BaseExtCtrl):
 
@@ -407,106 +413,401 @@ class PointControl(BaseExtCtrl):
     #point controls are not intended to be set
     #def set_value(self):
 
+# accessor prefix: (control classes, flag disabling the accessor,
+# control attribute returned or None for the control object itself)
+_accessors = {
+    'GET_CTRL_PREFEX': ((IntegerControl, Integer64Control, StringControl),
+                        v4l2.V4L2_CTRL_FLAG_WRITE_ONLY, 'get_value'),
+    'SET_CTRL_PREFEX': ((IntegerControl, Integer64Control, StringControl),
+                        v4l2.V4L2_CTRL_FLAG_READ_ONLY, 'set_value'),
+    'TURN_ON_PREFEX': ((BooleanControl,), v4l2.V4L2_CTRL_FLAG_READ_ONLY, 'turn_on'),
+    'TURN_OFF_PREFEX': ((BooleanControl,), v4l2.V4L2_CTRL_FLAG_READ_ONLY, 'turn_off'),
+    'SWITCH_PREFEX': ((BooleanControl,), v4l2.V4L2_CTRL_FLAG_READ_ONLY, 'switch_val'),
+    'FIRE_PREFEX': ((ButtonControl,), v4l2.V4L2_CTRL_FLAG_READ_ONLY, 'press_button'),
+    'ARRAY_PREFEX': ((ArrayControl,), 0, None),
+    'POINT_PREFEX': ((PointControl,), 0, None),
+}
+
 class v4l2DeviceDynamicControls(v4l2DeviceBase):
     '''
     An extension of the v4l2DeviceBase class, aimed to dynamicly
     create and provide an interface for the v4l2 controls, automating
     all handling of controls.
+
+    The control functions (get_ctrl_*, set_ctrl_*, select_*, ...) are
+    resolved through __getattr__ the first time they are used, so only
+    the controls that are actually accessed get queried.
     '''
+    #control value cache, None while disabled
+    _ctrl_cache = None
+
     def __init__(self, tup):
+        kwargs = tup[3]
         super(v4l2DeviceDynamicControls, self).__init__(tup)
         self._controls = {}
-        for ctrl in self.controls_iterator():
+        self._control_names = None
+        self._control_ids = None
+        if kwargs and kwargs.get('control_cache') is True:
+            self.enable_control_cache()
+        self.device_wrapper_list.append('Dynamic Controls')
+
+    def cleanup(self):
+        super(v4l2DeviceDynamicControls, self).cleanup()
 
+    # control value cache
+
+    def enable_control_cache(self):
+        '''
+        enables caching of control values read through get_ctrl.
+        Writes through set_ctrl update the cache. If the wrapper
+        handles events, every cached control is subscribed to
+        V4L2_EVENT_CTRL and cached reads first apply the changes
+        reported by the device, without blocking and leaving other
+        events queued. Volatile controls are never cached.
+        The 'control_cache' keyword enables the cache on creation
+        '''
+        if self._ctrl_cache is not None:
+            return
+        if not hasattr(self, 'subscribe_event'):
+            self.logger.warning('Control cache: wrapper does not handle events, '
+                                'changes made by other processes will not be seen')
+        else:
+            self.add_event_handler(v4l2.V4L2_EVENT_CTRL, self._update_ctrl_cache)
+        self._ctrl_cache = {}
+        self._ctrl_subscribed = set()
+        self._ctrl_uncached = set()
+
+    def disable_control_cache(self):
+        if self._ctrl_cache is None:
+            return
+        for ctrlid in self._ctrl_subscribed:
+            try:
+                self.unsubscribe_event(v4l2.V4L2_EVENT_CTRL, id=ctrlid)
+            except (IOError, DeviceError):
+                pass
+        if hasattr(self, 'remove_event_handler'):
+            self.remove_event_handler(v4l2.V4L2_EVENT_CTRL, self._update_ctrl_cache)
+        self._ctrl_cache = None
+
+    def refresh_control_cache(self):
+        '''
+        applies the pending control change events to the cache,
+        returns the number of events handled. Other pending events
+        are passed to their handlers as well
+        '''
+        if self._ctrl_cache is None or not self._ctrl_subscribed:
+            return 0
+        return self.drain_events(0)
+
+    def get_ctrl(self, ctrlid):
+        cache = self._ctrl_cache
+        if cache is None:
+            return super(v4l2DeviceDynamicControls, self).get_ctrl(ctrlid)
+        if ctrlid in cache:
+            self._sync_ctrl_cache()
+            if ctrlid in cache:
+                return cache[ctrlid]
+        value = super(v4l2DeviceDynamicControls, self).get_ctrl(ctrlid)
+        if self._ctrl_cacheable(ctrlid):
+            cache[ctrlid] = value
+        return value
+
+    def set_ctrl(self, ctrl, val, strmoff=False):
+        ret = super(v4l2DeviceDynamicControls, self).set_ctrl(ctrl, val, strmoff)
+        if self._ctrl_cache is not None and ctrl in self._ctrl_cache:
+            self._ctrl_cache[ctrl] = getattr(val, 'value', val)
+        return ret
+
+    def get_ctrl_values(self, ctrls):
+        cache = self._ctrl_cache
+        if cache is None:
+            return super(v4l2DeviceDynamicControls, self).get_ctrl_values(ctrls)
+        self._sync_ctrl_cache()
+        missing = [ctrl for ctrl in ctrls if ctrl.id not in cache]
+        fetched = dict(zip([ctrl.id for ctrl in missing],
+                           super(v4l2DeviceDynamicControls, self).get_ctrl_values(missing)))
+        for ctrl in missing:
+            if (not ctrl.flags & v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD and
+                self._ctrl_cacheable(ctrl.id)):
+                cache[ctrl.id] = fetched[ctrl.id]
+        return [cache[ctrl.id] if ctrl.id in cache else fetched[ctrl.id] for ctrl in ctrls]
+
+    def set_ctrl_values(self, values, strmoff=False):
+        cache = self._ctrl_cache
+        try:
+            super(v4l2DeviceDynamicControls, self).set_ctrl_values(values, strmoff)
+        except Exception:
+            #some control classes may have been written
+            if cache is not None:
+                for (ctrl, value) in values:
+                    cache.pop(ctrl.id, None)
+            raise
+        if cache is not None:
+            for (ctrl, value) in values:
+                if ctrl.id in cache:
+                    cache[ctrl.id] = value
+
+    def close_fd(self):
+        super(v4l2DeviceDynamicControls, self).close_fd()
+        #changes are not reported while no file handle is open. Controls
+        #are subscribed again, opening a file handle, when next read
+        if self._ctrl_cache is not None:
+            self._ctrl_cache.clear()
+            self._ctrl_subscribed.clear()
+
+    # control profiles
+
+    def snapshot_controls(self):
+        '''
+        returns a profile holding the current value of every writable control.
+        The profile is a dict with control names as keys, like v4l2_presets,
+        array control values are lists. It can be stored (e.g. as json) and
+        applied again with apply_profile
+        '''
+        ctrls = self._profile_controls()
+        profile = {}
+        for (ctrl, value) in zip(ctrls, self.get_ctrl_values(ctrls)):
+            if ctrl.flags & v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD:
+                value = value.tolist()
+            profile[ctrl.name.decode('UTF-8')] = value
+        return profile
+
+    def apply_profile(self, profile, strmoff=False):
+        '''
+        writes the controls of a profile (see snapshot_controls) whose value
+        differs from the current one, with one VIDIOC_S_EXT_CTRLS per control
+        class. Controls not in the profile are left untouched.
+        If a write fails, the changed controls are set back to their
+        previous values and the error is raised.
+        returns the number of controls written
+        '''
+        names = dict((ctrl.name.decode('UTF-8'), ctrl) for ctrl in self._profile_controls())
+        unknown = [name for name in profile if name not in names]
+        if unknown:
+            raise ControlError('Profile contains unknown or read only controls: {}'.format(unknown))
+        ctrls = [names[name] for name in profile]
+        changes = []
+        previous = []
+        for (ctrl, current) in zip(ctrls, self.get_ctrl_values(ctrls)):
+            value = profile[ctrl.name.decode('UTF-8')]
+            if ctrl.flags & v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD:
+                if np.array_equal(np.ravel(value), current):
+                    continue
+            elif value == current:
+                continue
+            changes.append((ctrl, value))
+            previous.append((ctrl, current))
+        if not changes:
+            return 0
+        try:
+            self.set_ctrl_values(changes, strmoff=strmoff)
+        except (IOError, DeviceError):
+            try:
+                self.set_ctrl_values(previous)
+            except (IOError, DeviceError) as e:
+                self.logger.warning('Profile: failed to restore controls: {}'.format(e))
+            raise
+        return len(changes)
+
+    def _profile_controls(self):
+        '''controls that can be stored in a profile'''
+        ctrls = []
+        for ctrl in self.list_controls():
+            if (ctrl.flags & (v4l2.V4L2_CTRL_FLAG_DISABLED |
+                              v4l2.V4L2_CTRL_FLAG_READ_ONLY |
+                              v4l2.V4L2_CTRL_FLAG_WRITE_ONLY |
+                              v4l2.V4L2_CTRL_FLAG_VOLATILE)):
+                continue
+            if ctrl.flags & v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD:
+                if (ctrl.type == v4l2.V4L2_CTRL_TYPE_STRING or
+                    ctrl.type >= v4l2.V4L2_CTRL_COMPOUND_TYPES or
+                    _elem_dtype(ctrl) is None):
+                    continue
+            elif ctrl.type not in (v4l2.V4L2_CTRL_TYPE_INTEGER,
+                                   v4l2.V4L2_CTRL_TYPE_BOOLEAN,
+                                   v4l2.V4L2_CTRL_TYPE_MENU,
+                                   v4l2.V4L2_CTRL_TYPE_INTEGER_MENU,
+                                   v4l2.V4L2_CTRL_TYPE_INTEGER64):
+                continue
+            ctrls.append(ctrl)
+        return ctrls
+
+    def _ctrl_cacheable(self, ctrlid):
+        if ctrlid in self._ctrl_subscribed:
+            return True
+        if ctrlid in self._ctrl_uncached:
+            return False
+        ctrl = self._control_id_map().get(ctrlid)
+        if ctrl is None or ctrl.flags & v4l2.V4L2_CTRL_FLAG_VOLATILE:
+            self._ctrl_uncached.add(ctrlid)
+            return False
+        if not hasattr(self, 'subscribe_event'):
+            return True
+        try:
+            #feedback makes the driver report the value it actually applied
+            self.subscribe_event(v4l2.V4L2_EVENT_CTRL, id=ctrlid,
+                                 flags=v4l2.V4L2_EVENT_SUB_FL_ALLOW_FEEDBACK)
+        except (IOError, DeviceError) as e:
+            self.logger.debug('Control cache: unable to subscribe to control {}: {}'.format(ctrlid, e))
+            self._ctrl_uncached.add(ctrlid)
+            return False
+        self._ctrl_subscribed.add(ctrlid)
+        return True
+
+    def _sync_ctrl_cache(self):
+        '''applies pending control events without blocking, other
+           events stay queued'''
+        if self._ctrl_subscribed:
+            self.drain_events(0, types=(v4l2.V4L2_EVENT_CTRL,))
+
+    def _update_ctrl_cache(self, event):
+        if self._ctrl_cache is None or event.type != v4l2.V4L2_EVENT_CTRL:
+            return
+        ctrl = event._u.ctrl
+        if ctrl.changes & v4l2.V4L2_EVENT_CTRL_CH_VALUE and event.id in self._ctrl_subscribed:
+            if ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER64:
+                self._ctrl_cache[event.id] = ctrl._u.value64
+            else:
+                self._ctrl_cache[event.id] = ctrl._u.value
+
+    def _control_id_map(self):
+        if self._control_ids is None:
+            self._control_ids = dict((ctrl.id, ctrl) for ctrl in self.list_controls())
+        return self._control_ids
+
+    def __getattr__(self, name):
+        attr = None
+        if not name.startswith('_') and '_controls' in self.__dict__:
+            attr = self._resolve_accessor(name)
+        if attr is None:
+            raise AttributeError('\'{}\' object has no attribute \'{}\''.format(
+                                        type(self).__name__, name))
+        setattr(self, name, attr)
+        return attr
+
+    def __dir__(self):
+        names = set(dir(type(self))) | set(self.__dict__)
+        for (formname, ctrl) in self._control_name_map().items():
+            cls = self._dynamic_control(ctrl)
+            if isinstance(cls, MenuControl):
+                names.update(_mdata['SELECT_PREFEX'] + formname + '_' + itmname
+                             for (itmname, func) in cls.menuitems)
+                continue
+            for key in _accessors:
+                if self._control_accessor(key, cls) is not None:
+                    names.add(_mdata[key] + formname)
+        return sorted(names)
+
+    def _control_name_map(self):
+        '''maps formatted control names to query structures, the device
+        controls are enumerated on first use'''
+        if self._control_names is not None:
+            return self._control_names
+        names = {}
+        for ctrl in self.list_controls():
             if ( ctrl.flags & v4l2.V4L2_CTRL_FLAG_DISABLED or
                  ctrl.type == v4l2.V4L2_CTRL_TYPE_CTRL_CLASS ):
                 self.logger.debug('Control \'{}\' either disabled or '
                               'control class, continuing'.format(ctrl.name.decode('UTF-8')))
                 continue
-
             formname = clean(ctrl.name.decode('UTF-8'))
             if keyword.iskeyword(formname):
-                raise ControlError('Formatted device name is a keyword: {}'.format(formname))
-            if (ctrl.flags & v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD):
-                qex = self.query_ext_ctrl(ctrl.id)
-                if ctrl.type == v4l2.V4L2_CTRL_TYPE_STRING:
-                    cls = StringControl(qex, weakref.ref(self))
-                    if ctrl.flags & v4l2.V4L2_CTRL_FLAG_WRITE_ONLY:
-                        setattr(self, _mdata['SET_CTRL_PREFEX'] + formname, cls.set_value)
-                    elif ctrl.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY:
-                        setattr(self, _mdata['GET_CTRL_PREFEX'] + formname, cls.get_value)
-                    else:
-                        setattr(self, _mdata['SET_CTRL_PREFEX'] + formname, cls.set_value)
-                        setattr(self, _mdata['GET_CTRL_PREFEX'] + formname, cls.get_value)
-                elif qex.type >= v4l2.V4L2_CTRL_COMPOUND_TYPES:
-                    if qex.type == v4l2.V4L2_CTRL_TYPE_POINT:
-                        cls = PointControl(qex, weakref.ref(self))
-                        setattr(self, _mdata['POINT_PREFEX'] + formname, cls)
-                    else:
-                        #skip if control not implemented
-                        continue
-                #if not a compound then its an array
-                else:
-                    cls = ArrayControl(qex, weakref.ref(self))
-                    setattr(self, _mdata['ARRAY_PREFEX'] + formname, cls)
-            elif ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER:
-                cls = IntegerControl(ctrl, weakref.ref(self))
-                if ctrl.flags & v4l2.V4L2_CTRL_FLAG_WRITE_ONLY:
-                    setattr(self, _mdata['SET_CTRL_PREFEX'] + formname, cls.set_value)
-                elif ctrl.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY:
-                    setattr(self, _mdata['GET_CTRL_PREFEX'] + formname, cls.get_value)
-                else:
-                    setattr(self, _mdata['SET_CTRL_PREFEX'] + formname, cls.set_value)
-                    setattr(self, _mdata['GET_CTRL_PREFEX'] + formname, cls.get_value)
-            elif ctrl.type == v4l2.V4L2_CTRL_TYPE_BOOLEAN:
-                cls = BooleanControl(ctrl, weakref.ref(self))
-                if ctrl.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY:
-                    pass
+                #keywords cannot be used as accessor names, e.g. get_ctrl_if_
+                self.logger.debug('Formatted device name is a keyword: {}, using {}_'.format(
+                                        formname, formname))
+                formname += '_'
+            names[formname] = ctrl
+        self._control_names = names
+        return names
+
+    def _dynamic_control(self, ctrl):
+        '''returns the control object for a query structure, creating it on first use'''
+        cls = self._controls.get(ctrl.id)
+        if cls is not None:
+            return cls
+        wref = weakref.ref(self)
+        if (ctrl.flags & v4l2.V4L2_CTRL_FLAG_HAS_PAYLOAD):
+            if ctrl.type == v4l2.V4L2_CTRL_TYPE_STRING:
+                cls = StringControl(ctrl, wref)
+            elif ctrl.type >= v4l2.V4L2_CTRL_COMPOUND_TYPES:
+                if ctrl.type == v4l2.V4L2_CTRL_TYPE_POINT:
+                    cls = PointControl(ctrl, wref)
                 else:
-                    setattr(self, _mdata['TURN_ON_PREFEX'] + formname, cls.turn_on)
-                    setattr(self, _mdata['TURN_OFF_PREFEX'] + formname, cls.turn_off)
-                    setattr(self, _mdata['SWITCH_PREFEX'] + formname, cls.switch_val)
-            elif ctrl.type == v4l2.V4L2_CTRL_TYPE_MENU:
-                cls = MenuControl(ctrl, weakref.ref(self))
-                for (itmname, func) in cls.menuitems:
-                    setattr(self, _mdata['SELECT_PREFEX']+formname+'_'+itmname, func)
-            elif ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER_MENU:
-                cls = IntegerMenuControl(ctrl, weakref.ref(self))
-                for (itmname, func) in cls.menuitems:
-                    setattr(self, _mdata['SELECT_PREFEX']+formname+'_'+itmname, func)
-            elif ctrl.type == v4l2.V4L2_CTRL_TYPE_BUTTON:
-                cls = ButtonControl(ctrl, weakref.ref(self))
-                if ctrl.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY:
-                    pass
-                else:
-                    setattr(self, _mdata['FIRE_PREFEX'] + formname, cls.press_button)
-            elif ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER64:
-                cls = Integer64Control(ctrl, weakref.ref(self))
-                if ctrl.flags & v4l2.V4L2_CTRL_FLAG_WRITE_ONLY:
-                    setattr(self, _mdata['SET_CTRL_PREFEX'] + formname, cls.set_value)
-                elif ctrl.flags & v4l2.V4L2_CTRL_FLAG_READ_ONLY:
-                    setattr(self, _mdata['GET_CTRL_PREFEX'] + formname, cls.get_value)
-                else:
-                    setattr(self, _mdata['SET_CTRL_PREFEX'] + formname, cls.set_value)
-                    setattr(self, _mdata['GET_CTRL_PREFEX'] + formname, cls.get_value)
+                    #skip if control not implemented
+                    return None
+            #if not a compound then its an array
             else:
-                self.logger.debug('Unknown control type {}, continuing'.format(ctrl.type))
+                cls = ArrayControl(ctrl, wref)
+        elif ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER:
+            cls = IntegerControl(ctrl, wref)
+        elif ctrl.type == v4l2.V4L2_CTRL_TYPE_BOOLEAN:
+            cls = BooleanControl(ctrl, wref)
+        elif ctrl.type == v4l2.V4L2_CTRL_TYPE_MENU:
+            cls = MenuControl(ctrl, wref)
+        elif ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER_MENU:
+            cls = IntegerMenuControl(ctrl, wref)
+        elif ctrl.type == v4l2.V4L2_CTRL_TYPE_BUTTON:
+            cls = ButtonControl(ctrl, wref)
+        elif ctrl.type == v4l2.V4L2_CTRL_TYPE_INTEGER64:
+            cls = Integer64Control(ctrl, wref)
+        else:
+            self.logger.debug('Unknown control type {}, continuing'.format(ctrl.type))
+            return None
+        self._controls[ctrl.name.decode('UTF-8').lower()] = cls
+        self._controls[ctrl.id] = cls
+        return cls
+
+    def _control_accessor(self, key, cls):
+        (types, flag, attr) = _accessors[key]
+        if not isinstance(cls, types) or cls.flags & flag:
+            return None
+        if attr is None:
+            return cls
+        return getattr(cls, attr)
+
+    def _resolve_accessor(self, name):
+        for (key, prefix) in _mdata.items():
+            if not name.startswith(prefix):
                 continue
-            self._controls[ctrl.name.decode('UTF-8').lower()] = cls
-            self._controls[ctrl.id] = cls
-        self.device_wrapper_list.append('Dynamic Controls')
-
-    def cleanup(self):
-        super(v4l2DeviceDynamicControls, self).cleanup()
+            formname = name[len(prefix):]
+            names = self._control_name_map()
+            if key == 'SELECT_PREFEX':
+                return self._resolve_menu_item(formname)
+            if formname not in names:
+                return None
+            cls = self._dynamic_control(names[formname])
+            if cls is None:
+                return None
+            return self._control_accessor(key, cls)
+        return None
+
+    def _resolve_menu_item(self, itemname):
+        '''select_ names are <control name>_<item name>, control names can
+        contain underscores so the longest matching control name wins'''
+        names = self._control_name_map()
+        for formname in sorted(names, key=len, reverse=True):
+            if not itemname.startswith(formname + '_'):
+                continue
+            cls = self._dynamic_control(names[formname])
+            if isinstance(cls, MenuControl):
+                func = cls.find_item(itemname[len(formname)+1:])
+                if func is not None:
+                    return func
+        return None
 
     def find_dynamic_control(self, ident):
         '''perform search for dynamic control. Can be control id or string(case insensitive)'''
-        try:
-            if isinstance(ident, str):
-                return self._controls[ident.lower()]
-            elif isinstance(ident, int):
-                return self._controls[ident]
-            else:
-                raise KeyError('Unable to find control with identifier of type {}'.format(type(ident)))
-        except KeyError:
-            raise KeyError('Unable to find dynamic control with key \'{}\''.format(str(ident)))
+        if isinstance(ident, str):
+            key = ident.lower()
+        elif isinstance(ident, int):
+            key = ident
+        else:
+            raise KeyError('Unable to find control with identifier of type {}'.format(type(ident)))
+        if key in self._controls:
+            return self._controls[key]
+        for ctrl in self._control_name_map().values():
+            if key == ctrl.id or key == ctrl.name.decode('UTF-8').lower():
+                cls = self._dynamic_control(ctrl)
+                if cls is not None:
+                    return cls
+        raise KeyError('Unable to find dynamic control with key \'{}\''.format(str(ident)))
@@ -15,13 +15,23 @@
 
 import v4l2
 from v4l2wrapper._wrappers.v4l2_device_Base import (v4l2DeviceBase,
-    LOGGING_LEVEL_FINE_GRAINED_DEBUG)
+    DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
 import select
+from collections import deque
 
 class v4l2DeviceEvents(v4l2DeviceBase):
 
     def __init__(self, tup):
         cap = tup[2]
+        #subscriptions, (type, id) -> flags, restored when the fd is reopened
+        self._subscriptions = {}
+        #event handlers, (type, id) -> list of handlers, id None matches any id
+        self._event_handlers = {}
+        self._event_epoll = None
+        #event structure reused by drain_events
+        self._event = v4l2.v4l2_event()
+        #copies of events dequeued by a filtered drain_events, delivered first
+        self._deferred_events = deque()
         super(v4l2DeviceEvents, self).__init__(tup)
 
         self.device_wrapper_list.append('Event')
@@ -33,37 +43,114 @@ class v4l2DeviceEvents(v4l2DeviceBase):
             self.logger.log(LOGGING_LEVEL_FINE_GRAINED_DEBUG, 'Events: In cleanup: {}'.format(str(e)))
         super(v4l2DeviceEvents, self).cleanup()
 
+    def open_fd(self, *args, **kwargs):
+        super(v4l2DeviceEvents, self).open_fd(*args, **kwargs)
+        #subscriptions belong to the file handle, restore them on the new one
+        for ((type, id), flags) in self._subscriptions.items():
+            eventsub = v4l2.v4l2_event_subscription(type=type, id=id, flags=flags)
+            try:
+                self._set_ioctl(v4l2.VIDIOC_SUBSCRIBE_EVENT, eventsub)
+            except (IOError, DeviceError) as e:
+                self.logger.debug('Events: unable to restore subscription {}: {}'.format((type, id), e))
+
+    def close_fd(self):
+        #the epoll registration belongs to the fd
+        if self._event_epoll is not None:
+            self._event_epoll.close()
+            self._event_epoll = None
+        super(v4l2DeviceEvents, self).close_fd()
+
     def subscribe_event(self, type, id=0, flags=None):
-        self.open_fd()
+        #subscriptions belong to the file handle, reopening would drop them
+        if not self.fd:
+            self.open_fd()
         eventsub = v4l2.v4l2_event_subscription(type=type, id=id)
         if flags:
             eventsub.flags = flags
         self._set_ioctl(v4l2.VIDIOC_SUBSCRIBE_EVENT, eventsub)
+        self._subscriptions[(type, id)] = eventsub.flags
 
-    def unsubscribe_event(self, type):
-        eventunsub = v4l2.v4l2_event_subscription(type=type)
+    def unsubscribe_event(self, type, id=0):
+        eventunsub = v4l2.v4l2_event_subscription(type=type, id=id)
         self._set_ioctl(v4l2.VIDIOC_UNSUBSCRIBE_EVENT, eventunsub)
+        if type == v4l2.V4L2_EVENT_ALL:
+            self._subscriptions.clear()
+        else:
+            self._subscriptions.pop((type, id), None)
 
     def reset_events(self):
         self.unsubscribe_event(type=v4l2.V4L2_EVENT_ALL)
 
+    def add_event_handler(self, type, handler, id=None):
+        '''
+        registers handler(event) to be called by drain_events for events of
+        the given type and id. With id None the handler gets the events of
+        every id. The event passed is reused, copy it to keep it
+        '''
+        self._event_handlers.setdefault((type, id), []).append(handler)
+
+    def remove_event_handler(self, type, handler, id=None):
+        handlers = self._event_handlers.get((type, id))
+        if handlers and handler in handlers:
+            handlers.remove(handler)
+            if not handlers:
+                del self._event_handlers[(type, id)]
+
     def get_event(self, timeout=0.5):
+        if self._deferred_events:
+            return self._deferred_events.popleft()
         if not self.check_for_event(timeout):
             return None
         event = v4l2.v4l2_event()
         self._set_ioctl(v4l2.VIDIOC_DQEVENT, event)
         return event
 
+    def drain_events(self, timeout=0, types=None):
+        '''
+        waits up to timeout seconds for an event, then dequeues every
+        pending event and passes it to the registered handlers. Events
+        without a handler are dropped. Returns the number of events handled.
+        If types is given, only events of those types are handled, the
+        others are kept in order for the next drain_events or get_event
+        '''
+        count = 0
+        if types is None:
+            while self._deferred_events:
+                self._dispatch_event(self._deferred_events.popleft())
+                count += 1
+        if not self.fd or not self._poll_event(timeout):
+            return count
+        event = self._event
+        while True:
+            self._set_ioctl(v4l2.VIDIOC_DQEVENT, event)
+            if types is None or event.type in types:
+                self._dispatch_event(event)
+                count += 1
+            else:
+                self._deferred_events.append(v4l2.v4l2_event.from_buffer_copy(event))
+            if not event.pending:
+                return count
+
+    def _dispatch_event(self, event):
+        handlers = self._event_handlers
+        for handler in handlers.get((event.type, event.id), ()):
+            handler(event)
+        for handler in handlers.get((event.type, None), ()):
+            handler(event)
+
     def check_for_event(self, timeout=0):
         ''' attempts to get an event, also throws event exceptions '''
-        epoll = select.epoll()
-        epoll.register(self.fd, select.EPOLLPRI)
-
-        if epoll.poll(timeout):
-            epoll.close()
+        if self._deferred_events:
             return True
-        epoll.close()
-        return False
+        if not self.fd:
+            return False
+        return self._poll_event(timeout)
+
+    def _poll_event(self, timeout):
+        if self._event_epoll is None:
+            self._event_epoll = select.epoll()
+            self._event_epoll.register(self.fd, select.EPOLLPRI)
+        return bool(self._event_epoll.poll(timeout))
 
     def pprint_event(self, event):
         print ('=== event informaton ===')
@@ -13,6 +13,7 @@
 import v4l2
 from v4l2wrapper._wrappers.v4l2_device_Base import (
     v4l2DeviceBase, DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
+from v4l2wrapper._wrappers.spectral_index import SpectralIndex
 import numpy as np
 import select, errno, os
 
@@ -22,6 +23,117 @@ DEFAULT_MOSAIC = np.array([[739,753,727,713,688],
                   [600,609,874,864,672],
                   [790,802,778,765,673]])
 
+#mosaic bytes -> _MosaicIndex
+_mosaic_indexes = {}
+
+class _MosaicIndex(object):
+    '''
+    positions of the bands in a mosaic. rows/cols hold the position of every
+    mosaic cell ordered by wavelength, cells with the same wavelength keep
+    their raster order. first maps a wavelength to its first position
+    '''
+    def __init__(self, mosaic):
+        flat = mosaic.ravel()
+        order = np.argsort(flat, kind='mergesort')
+        self.shape = mosaic.shape
+        self.wavelengths = flat[order]
+        (self.rows, self.cols) = np.unravel_index(order, mosaic.shape)
+        self.first = {}
+        for (band, row, col) in zip(flat.tolist(), *np.unravel_index(np.arange(flat.size), mosaic.shape)):
+            self.first.setdefault(band, (int(row), int(col)))
+
+def _mosaic_index(mosaic):
+    mosaic = np.asarray(mosaic)
+    key = (mosaic.shape, mosaic.dtype.str, mosaic.tobytes())
+    index = _mosaic_indexes.get(key)
+    if index is None:
+        index = _mosaic_indexes[key] = _MosaicIndex(mosaic)
+    return index
+
+def mosaic_wavelengths(mosaic=DEFAULT_MOSAIC):
+    '''
+    returns the wavelengths of the planes of a cube captured with mosaic
+    '''
+    return _mosaic_index(mosaic).wavelengths.copy()
+
+class ReflectanceCalibrator(object):
+    '''
+    converts raw frames to relative reflectance using a white and a black
+    reference frame. (1 / (white - black)) and black are computed once, so
+    a frame costs one subtraction, one multiplication and one clip. Pixels
+    where white equals black come out as 0
+    '''
+
+    def __init__(self, whiteref, blackref):
+        if whiteref.shape != blackref.shape or whiteref.dtype != blackref.dtype:
+            raise DeviceError("The shape or type of the whiteref and blackref "
+                "do not match for relative reflectance")
+        offset = blackref.astype(np.float32)
+        denominator = whiteref.astype(np.float32)
+        denominator -= offset
+        scale = np.zeros(denominator.shape, dtype=np.float32)
+        np.divide(1.0, denominator, out=scale, where=denominator > 0)
+        self._set_terms(offset, scale)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        loads a calibration written by save. By default the file is memory
+        mapped instead of read
+        '''
+        terms = np.load(path, mmap_mode=mmap_mode)
+        if terms.ndim != 3 or terms.shape[0] != 2 or terms.dtype != np.float32:
+            raise DeviceError("{} does not hold a reflectance calibration".format(path))
+        calibrator = cls.__new__(cls)
+        calibrator._set_terms(terms[0], terms[1])
+        return calibrator
+
+    def save(self, path):
+        '''
+        writes the calibration to a .npy file
+        '''
+        np.save(path, np.stack((self.offset, self.scale)))
+
+    def _set_terms(self, offset, scale):
+        self.offset = offset
+        self.scale = scale
+        self.shape = offset.shape
+        #scale multiplied by the maximum of an integer type, by type
+        self._int_scales = {}
+        self._work = None
+
+    def apply(self, img, out=None, reflectance=False):
+        '''
+        returns the relative reflectance of img. With reflectance False the
+        result has the type of img and 1.0 maps to the maximum of the type,
+        like capture_hspec_image. With reflectance True the result is float32
+        in [0, 1]. out may be a preallocated result, it can be img itself
+        '''
+        if img.shape != self.shape:
+            raise DeviceError("The shape of the captured image and the reflectance "
+                "calibration do not match")
+        if reflectance:
+            if out is None:
+                out = np.empty(self.shape, dtype=np.float32)
+            np.subtract(img, self.offset, out=out, casting='unsafe')
+            np.multiply(out, self.scale, out=out, casting='unsafe')
+            return np.clip(out, 0.0, 1.0, out=out)
+
+        maximum = np.iinfo(img.dtype).max
+        scale = self._int_scales.get(maximum)
+        if scale is None:
+            scale = self._int_scales[maximum] = self.scale * np.float32(maximum)
+        if self._work is None:
+            self._work = np.empty(self.shape, dtype=np.float32)
+        work = self._work
+        np.subtract(img, self.offset, out=work)
+        np.multiply(work, scale, out=work)
+        np.clip(work, 0, maximum, out=work)
+        if out is None:
+            return work.astype(img.dtype)
+        np.copyto(out, work, casting='unsafe')
+        return out
+
 class v4l2DeviceHyperspectral(v4l2DeviceBase):
     '''
     Provides an interface for handling read/write system calls
@@ -34,19 +146,72 @@ class v4l2DeviceHyperspectral(v4l2DeviceBase):
         type_ctrl = self.find_ctrl('Sensor Type')
         qry = self.query_ext_ctrl(type_ctrl.id)
         stype = self.get_ext_ctrl(qry)
-        if stype.controls[0].string[-2:] != "IR":
+        if stype.controls[0].string[-2:] not in ("IR", b"IR"):
             raise DeviceError("Hyperspectral: sensor is not a hyperspectral sensor")
+        #wavelengths of the planes returned by capture_hspec_cube
+        self.wavelengths = mosaic_wavelengths(DEFAULT_MOSAIC)
+        #(whiteref, blackref, ReflectanceCalibrator) of the last references used
+        self._calibration = None
+        #(expression, wavelengths) -> SpectralIndex
+        self._spectral_indexes = {}
         self.device_wrapper_list.append('Hyperspectral')
 
     def cleanup(self):
-       	super(v4l2DeviceHyperspectral, self).cleanup()
+        for index in self._spectral_indexes.values():
+            index.close()
+        self._spectral_indexes.clear()
+        super(v4l2DeviceHyperspectral, self).cleanup()
 
-    def capture_hspec_image(self, bands=None, whiteref=None, blackref=None, v4l2fmt=v4l2.V4L2_PIX_FMT_Y16_BE, mosaic=DEFAULT_MOSAIC):
+    def capture_hspec_image(self, bands=None, whiteref=None, blackref=None, v4l2fmt=v4l2.V4L2_PIX_FMT_Y16_BE,
+                            mosaic=DEFAULT_MOSAIC, calibrator=None):
         """ returns a dictionary with the bands specified by the user. If no
             bands are specified, all bands are returned. If both whiteref and blackref
-            are defined, the relative reflectance of the image is calcuated
+            are defined, the relative reflectance of the image is calcuated. A
+            ReflectanceCalibrator can be passed instead of the references
         """
+        img = self._capture_hspec_frame(whiteref, blackref, v4l2fmt, calibrator)
 
+        index = _mosaic_index(mosaic)
+        mx,my = index.shape
+        if bands is None:
+            bands = index.first.keys()
+        bandlist = {}
+        for band in bands:
+            if band not in index.first:
+                raise Exception("Band {} is not part of the mosaic".format(band))
+            (xl, yl) = index.first[band]
+            bandlist[band] = img[xl::mx,yl::my]
+
+        return bandlist
+
+    def capture_hspec_cube(self, whiteref=None, blackref=None, v4l2fmt=v4l2.V4L2_PIX_FMT_Y16_BE,
+                           mosaic=DEFAULT_MOSAIC, out=None, calibrator=None):
+        """ returns a contiguous (bands, height/my, width/mx) array with one plane
+            per mosaic cell, ordered by wavelength. self.wavelengths holds the
+            wavelength of every plane. out can be a preallocated array of that
+            shape. whiteref, blackref and calibrator work like in capture_hspec_image
+        """
+        img = self._capture_hspec_frame(whiteref, blackref, v4l2fmt, calibrator)
+        index = _mosaic_index(mosaic)
+        out = hspec_cube(img, mosaic, out)
+        self.wavelengths = index.wavelengths.copy()
+        return out
+
+    def compute_index(self, expression, cube=None, out=None, workers=None):
+        """ evaluates a spectral index expression such as '(b843-b664)/(b843+b664)'
+            on a cube from capture_hspec_cube, capturing one if cube is None.
+            Returns a float32 (height, width) array, see SpectralIndex.
+            Expressions are compiled once and reused
+        """
+        if cube is None:
+            cube = self.capture_hspec_cube()
+        key = (expression, tuple(self.wavelengths.tolist()))
+        index = self._spectral_indexes.get(key)
+        if index is None:
+            index = self._spectral_indexes[key] = SpectralIndex(expression, self.wavelengths)
+        return index.evaluate(cube, out, workers)
+
+    def _capture_hspec_frame(self, whiteref, blackref, v4l2fmt, calibrator=None):
         fmt = self.get_fmt()
         fmt.fmt.pix.pixelformat = v4l2fmt
         self.set_fmt(fmt, strmoff=True)
@@ -54,23 +219,43 @@ class v4l2DeviceHyperspectral(v4l2DeviceBase):
         self._stream_ioctl_off()
         #perform relative reflectance
 
-        if whiteref != None and blackref != None:
+        if calibrator is None and whiteref is not None and blackref is not None:
             if (whiteref.shape == blackref.shape == img.shape) and (whiteref.dtype == blackref.dtype == img.dtype):
-                mask = img < blackref
-                img = (((img-blackref).astype(np.float32)/(whiteref-blackref)) * np.iinfo(img.dtype).max).astype(img.dtype)
-                img[mask] = 0
+                calibrator = self._reflectance_calibrator(whiteref, blackref)
             else:
                 raise DeviceError("The shape or type of the whiteref,blackref and captured image "
                     "do not match for relative reflectance")
+        if calibrator is not None:
+            img = calibrator.apply(img, out=img)
+        return img
 
-        mx,my = mosaic.shape
-        if bands == None:
-            bands = mosaic.ravel()
-        bandlist = {}
-        for band in bands:
-            xl, yl = np.where(mosaic == band)
-            if xl.size == 0 or yl.size == 0:
-                raise Exception("Band {} is not part of the mosaic".format(band))
-            bandlist[band] = img[xl[0]::mx,yl[0]::my]
+    def _reflectance_calibrator(self, whiteref, blackref):
+        '''
+        returns the calibrator of the reference pair, reused while the
+        same reference arrays are passed
+        '''
+        calibration = self._calibration
+        if calibration is None or calibration[0] is not whiteref or calibration[1] is not blackref:
+            calibration = self._calibration = (whiteref, blackref,
+                                               ReflectanceCalibrator(whiteref, blackref))
+        return calibration[2]
 
-        return bandlist
+def hspec_cube(img, mosaic=DEFAULT_MOSAIC, out=None):
+    '''
+    splits a raw mosaic frame into a (bands, height/my, width/mx) cube ordered
+    by wavelength, copying every pixel once. Incomplete mosaic tiles at the
+    right and bottom edges are dropped
+    '''
+    index = _mosaic_index(mosaic)
+    (mx, my) = index.shape
+    (h, w) = (img.shape[0] // mx, img.shape[1] // my)
+    #(mosaic row, mosaic column, row, column) view of the frame
+    tiles = img[:h * mx, :w * my].reshape(h, mx, w, my).transpose(1, 3, 0, 2)
+    shape = (len(index.wavelengths), h, w)
+    if out is None:
+        out = np.empty(shape, dtype=img.dtype)
+    elif out.shape != shape:
+        raise DeviceError("Hyperspectral: cube output has shape {}, expected {}".format(out.shape, shape))
+    for (plane, row, col) in zip(out, index.rows, index.cols):
+        np.copyto(plane, tiles[row, col])
+    return out
@@ -0,0 +1,146 @@
+'''
+    Streaming hyperspectral capture
+
+    Captures hyperspectral cubes through the mmap buffers of the streaming
+    wrapper instead of read calls, and records sequences of cubes to disk
+'''
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import v4l2
+from v4l2wrapper._wrappers.v4l2_device_Base import (
+    DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
+from v4l2wrapper._wrappers.v4l2_device_Hyperspectral import (
+    v4l2DeviceHyperspectral, DEFAULT_MOSAIC, hspec_cube, mosaic_wavelengths)
+from v4l2wrapper._wrappers.v4l2_device_Stream import v4l2DeviceStream
+from v4l2wrapper._wrappers.v4l2_device_RWCapability import _pixel_layout
+import numpy as np
+import struct
+import io
+
+class v4l2DeviceHyperspectralStream(v4l2DeviceHyperspectral, v4l2DeviceStream):
+
+    def __init__(self, tup):
+        super(v4l2DeviceHyperspectralStream, self).__init__(tup)
+        self._hspec_stream = None
+        self.device_wrapper_list.append('HyperspectralStream')
+
+    def cleanup(self):
+        try:
+            self.stop_hspec_stream()
+        except Exception as e:
+            self.logger.log(LOGGING_LEVEL_FINE_GRAINED_DEBUG, 'HyperspectralStream: In cleanup: {}'.format(str(e)))
+        super(v4l2DeviceHyperspectralStream, self).cleanup()
+
+    def start_hspec_stream(self, v4l2fmt=v4l2.V4L2_PIX_FMT_Y16_BE, bufcount=4, mosaic=DEFAULT_MOSAIC):
+        '''
+        sets the format once and starts streaming into mmap buffers
+        '''
+        self.stop_hspec_stream()
+        fmt = self.get_fmt()
+        fmt.fmt.pix.pixelformat = v4l2fmt
+        self.set_fmt(fmt, strmoff=True)
+        fmt = self.get_cached_fmt()
+        (pixformat, colors) = _pixel_layout(fmt.fmt.pix.pixelformat)
+        if colors != 1:
+            raise DeviceError("HyperspectralStream: format {} is not a single channel format".format(v4l2fmt))
+        self.request_buffers(bufcount)
+        if not self.stream_on():
+            raise DeviceError("HyperspectralStream: unable to start streaming")
+        #(format, numpy type, mosaic, calibration frame)
+        self._hspec_stream = (fmt, np.dtype(pixformat), mosaic, None)
+        self.wavelengths = mosaic_wavelengths(mosaic)
+
+    def stop_hspec_stream(self):
+        if self._hspec_stream is None:
+            return
+        self._hspec_stream = None
+        self.stream_off()
+        self.cleanup_buffers()
+
+    def capture_hspec_stream_cube(self, out=None, calibrator=None, reflectance=False, timeout=None):
+        '''
+        dequeues the next frame of the stream started with start_hspec_stream
+        and returns (FrameInfo, cube), see capture_hspec_cube. calibrator is
+        an optional ReflectanceCalibrator, with reflectance True the cube
+        holds float32 reflectance. Returns (None, None) on timeout
+        '''
+        if self._hspec_stream is None:
+            raise DeviceError("HyperspectralStream: stream not started")
+        (fmt, dtype, mosaic, frame) = self._hspec_stream
+        info, buf = self.get_frame(timeout=timeout)
+        if info is None:
+            return None, None
+        pix = fmt.fmt.pix
+        raw = np.frombuffer(buf, dtype, count=pix.height * pix.width).reshape(pix.height, pix.width)
+        if calibrator is not None:
+            frame_dtype = np.dtype(np.float32) if reflectance else dtype
+            if frame is None or frame.dtype != frame_dtype:
+                frame = np.empty(raw.shape, dtype=frame_dtype)
+                self._hspec_stream = (fmt, dtype, mosaic, frame)
+            raw = calibrator.apply(raw, out=frame, reflectance=reflectance)
+        return info, hspec_cube(raw, mosaic, out)
+
+    def record_hspec_cubes(self, path, frames, calibrator=None, reflectance=False, timeout=None):
+        '''
+        captures frames cubes from the running stream into a preallocated
+        (frames, bands, height, width) .npy file at path, written through a
+        memory map. Stops early on timeout, the file is then truncated to the
+        cubes captured. Returns an int64 array with the timestamp_ns of every
+        recorded cube
+        '''
+        if self._hspec_stream is None:
+            raise DeviceError("HyperspectralStream: stream not started")
+        (fmt, dtype, mosaic, frame) = self._hspec_stream
+        pix = fmt.fmt.pix
+        (mx, my) = np.shape(mosaic)
+        shape = (frames, np.size(mosaic), pix.height // mx, pix.width // my)
+        if calibrator is not None and reflectance:
+            dtype = np.float32
+        dataset = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        timestamps = np.zeros(frames, dtype=np.int64)
+        try:
+            for i in range(frames):
+                info, cube = self.capture_hspec_stream_cube(dataset[i], calibrator, reflectance, timeout)
+                if info is None:
+                    self.logger.warning('HyperspectralStream: timeout after {} of {} frames'.format(i, frames))
+                    timestamps = timestamps[:i]
+                    break
+                timestamps[i] = info.timestamp_ns
+        finally:
+            dataset.flush()
+            del dataset
+        if len(timestamps) < frames:
+            _truncate_npy(path, len(timestamps))
+        return timestamps
+
+
+def _truncate_npy(path, count):
+    '''shrinks the first axis of the .npy file at path to count entries'''
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+        else:
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        shape = (count,) + tuple(shape[1:])
+        header = io.BytesIO()
+        d = {'descr': np.lib.format.dtype_to_descr(dtype),
+             'fortran_order': fortran_order, 'shape': shape}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, d)
+            lenfmt = '<H'
+        else:
+            np.lib.format.write_array_header_2_0(header, d)
+            lenfmt = '<I'
+        header = header.getvalue()
+        if len(header) < offset:
+            #the data must not move, pad the header to its previous length
+            header = header[:-1] + b' ' * (offset - len(header)) + b'\n'
+            start = 8 + struct.calcsize(lenfmt)
+            header = header[:8] + struct.pack(lenfmt, offset - start) + header[start:]
+        f.seek(0)
+        f.write(header)
+        f.truncate(offset + count * int(np.prod(shape[1:])) * dtype.itemsize)
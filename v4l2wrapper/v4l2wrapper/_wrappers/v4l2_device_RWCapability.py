@@ -18,10 +18,14 @@
 import v4l2
 from v4l2wrapper._wrappers.v4l2_device_Base import (v4l2DeviceBase,
     DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
+from v4l2wrapper._wrappers.profiling import perf_counter_ns
 import numpy as np
 import select, errno, os
 from numbers import Number
 
+#size of the reads made by capture_byte_by_byte
+CHUNK_SIZE = 4096
+
 class v4l2DeviceRWCap(v4l2DeviceBase):
     '''
     Provides an interface for handling read/write system calls
@@ -35,12 +39,16 @@ class v4l2DeviceRWCap(v4l2DeviceBase):
             raise DeviceError("DeviceWRCap: Attempted to wrap device that doesn't support Read/Write")
         self.device_wrapper_list.append('RWCap')
         self.capture_timeout = 3
+        #frame buffer reused by every capture
+        self._frame_buffer = None
+        self._capture_layout = None
         if kwargs is not None:
             if 'capture_timeout' in kwargs:
                 if isinstance(kwargs['capture_timeout'], Number):
                     self.capture_timeout = kwargs['capture_timeout']
 
     def cleanup(self):
+        self._frame_buffer = None
         super(v4l2DeviceRWCap, self).cleanup()
 
     def read(self, size=-1):
@@ -94,180 +102,200 @@ class v4l2DeviceRWCap(v4l2DeviceBase):
             return False
         return True
 
-    def capture(self, timeout=None, fmt=None):
+    def capture(self, timeout=None, fmt=None, copy=True):
         '''
         performs read from device and formats into correct image format
         returns a numpy structure with image information
         If image capture fails, None is returned
-        '''
-
-        if not fmt:
-            fmt = self.get_fmt()
-        else:
-            self.set_fmt(fmt, strmoff=True)
 
+        The fd is kept open between captures and the frame is read into a
+        buffer reused by every capture. With copy=False the result may be a
+        view of that buffer, only valid until the next capture
+        '''
         if not timeout:
             timeout = self.capture_timeout
-        self._strmoff_force_fd_reset = True
-        self.open_fd()
-        if (timeout>=0):
-            ready = select.select([self.fd], [], [], timeout)
-            if not ready[0]:
-                return None
-
-        if  ((fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y10) or
-             (fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y12) or
-             (fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y16) or
-             (fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_QTEC_GREEN16)) :
-            pixformat = '<u2'
-        elif ((fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y16_BE) or
-             (fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_QTEC_GREEN16_BE)) :
-            pixformat = '>u2'
-        else:
-            pixformat = np.uint8
-
-        if fmt.fmt.pix.pixelformat == v4l2.v4l2_fourcc('Q', '5', '4', '0'):
-            colors = 5
-        elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_RGB32 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR32:
-            colors = 4
-        elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_RGB24 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
-            colors = 3
-        elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
-            colors = 2
-        else:
-            colors = 1
+        (fmt, pixformat, colors, nbytes) = self._prepare_capture(fmt)
 
-        buf = os.read(self.fd, fmt.fmt.pix.height * fmt.fmt.pix.width * colors)
-        self.close_fd()
-        data = np.frombuffer(buf, dtype=pixformat)
-
-        if data is None or data.size == 0:
+        view = memoryview(self._frame_buffer)[:nbytes]
+        if self._read_into(view, timeout) < nbytes:
             return None
 
-        if colors == 1:
-            data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width))
-        else:
-            data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width, colors))
-
-        if colors > 3:
-            data = data[:, :, 0:3]
-
-        if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR32 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
-            data = data[:, :, [2, 1, 0]]
-
-        if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
-            data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width / 2, 4)).astype('int32')
-            rgb = np.empty((fmt.fmt.pix.height, fmt.fmt.pix.width / 2, 6))
-            if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV:
-                y1 = data[:, :, 0]
-                y2 = data[:, :, 2]
-                u = data[:, :, 1]
-                v = data[:, :, 3]
-            else:
-                y1 = data[:, :, 1]
-                y2 = data[:, :, 3]
-                v = data[:, :, 2]
-                u = data[:, :, 0]
-
-            rgb[:, :, 0] = (298 * (y1 - 16) + 409 * (v - 128) + 128) / 256
-            rgb[:, :, 1] = (298 * (y1 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
-            rgb[:, :, 2] = (298 * (y1 - 16) + 516 * (u - 128) + 128) / 256
-            rgb[:, :, 3] = (298 * (y2 - 16) + 409 * (v - 128) + 128) / 256
-            rgb[:, :, 4] = (298 * (y2 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
-            rgb[:, :, 5] = (298 * (y2 - 16) + 516 * (u - 128) + 128) / 256
-            rgb = np.clip(rgb, 0, 255)
-            data = rgb.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width, 3)).astype('uint8')
+        start = self._tstamp()
+        data = self._frame_buffer[:nbytes].view(pixformat)
+        data = _format_frame(data, fmt.fmt.pix, colors)
+        if copy and np.may_share_memory(data, self._frame_buffer):
+            data = data.copy()
+        self._tstage('decode', start)
         return data
 
-
     def capture_byte_by_byte(self, fmt=None, timeout=None):
         '''
         performs read from device and formats into correct image format
         returns a numpy structure with image information
         If image capture fails, None is returned
 
-        This version reads from the buffer byte by byte,checking if the fd is set.
-        It is a slower version that protects from performing reads that are larger
-        than the data in the buffer.
+        This version reads the frame in chunks of at most CHUNK_SIZE bytes,
+        checking with select before every read. It is a slower version that
+        protects from performing reads that are larger than the data in the buffer.
         '''
-        if not fmt:
-            fmt = self.get_fmt()
-        else:
-            self.set_fmt(fmt, strmoff=True)
-
         if not timeout:
             timeout = self.capture_timeout
-        self._strmoff_force_fd_reset = True
-        self.open_fd()
-        if (timeout>=0):
-            ready = select.select([self.fd], [], [], timeout)
-            if not ready[0]:
-                return None
-
-        if  ((fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y10) or
-             (fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y12) or
-             (fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y16) or
-             (fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_QTEC_GREEN16)) :
-            pixformat = '<u2'
-        elif ((fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_Y16_BE) or
-             (fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_QTEC_GREEN16_BE)) :
-            pixformat = '>u2'
-        else:
-            pixformat = np.uint8
-
-        if fmt.fmt.pix.pixelformat == v4l2.v4l2_fourcc('Q', '5', '4', '0'):
-            colors = 5
-        elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_RGB32 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR32:
-            colors = 4
-        elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_RGB24 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
-            colors = 3
-        elif fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
-            colors = 2
-        else:
-            colors = 1
+        (fmt, pixformat, colors, nbytes) = self._prepare_capture(fmt)
 
-        dsize = fmt.fmt.pix.height * fmt.fmt.pix.width * colors
-        data = np.empty([dsize], dtype=pixformat)
+        view = memoryview(self._frame_buffer)[:nbytes]
+        if self._read_into(view, timeout, CHUNK_SIZE) < nbytes:
+            return None
 
-        for i in range(fmt.fmt.pix.height * fmt.fmt.pix.width * colors):
-            if self.select_for_read(timeout=1):
-                data[i] = ord(self.raw_read())
-            else:
-                return None
-        self.close_fd()
+        start = self._tstamp()
+        data = _format_frame(self._frame_buffer[:nbytes].view(pixformat), fmt.fmt.pix, colors)
+        if np.may_share_memory(data, self._frame_buffer):
+            data = data.copy()
+        self._tstage('decode', start)
+        return data
 
-        if colors == 1:
-            data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width))
+    def benchmark_capture(self, frames=100, timeout=None, fmt=None):
+        '''
+        captures frames without copying them and returns the achieved
+        frames per second. Failed captures are not counted
+        '''
+        self._prepare_capture(fmt)
+        captured = 0
+        start = perf_counter_ns()
+        for _ in range(frames):
+            if self.capture(timeout, copy=False) is not None:
+                captured += 1
+        elapsed = perf_counter_ns() - start
+        if not elapsed:
+            return 0.0
+        return captured * 1e9 / elapsed
+
+    def _prepare_capture(self, fmt):
+        '''
+        applies fmt if given, opens the fd if needed and makes sure the frame
+        buffer fits a frame. Returns (format, numpy type, colors, frame size in bytes)
+        '''
+        if not fmt:
+            fmt = self.get_cached_fmt()
         else:
-            data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width, colors))
-
-        if colors > 3:
-            data = data[:, :, 0:3]
-
-        if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR32 or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
-            data = data[:, :, [2, 1, 0]]
-
-        if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV or fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
-            data = data.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width / 2, 4)).astype('int32')
-            rgb = np.empty((fmt.fmt.pix.height, fmt.fmt.pix.width / 2, 6))
-            if fmt.fmt.pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV:
-                y1 = data[:, :, 0]
-                y2 = data[:, :, 2]
-                u = data[:, :, 1]
-                v = data[:, :, 3]
-            else:
-                y1 = data[:, :, 1]
-                y2 = data[:, :, 3]
-                v = data[:, :, 2]
-                u = data[:, :, 0]
-
-            rgb[:, :, 0] = (298 * (y1 - 16) + 409 * (v - 128) + 128) / 256
-            rgb[:, :, 1] = (298 * (y1 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
-            rgb[:, :, 2] = (298 * (y1 - 16) + 516 * (u - 128) + 128) / 256
-            rgb[:, :, 3] = (298 * (y2 - 16) + 409 * (v - 128) + 128) / 256
-            rgb[:, :, 4] = (298 * (y2 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
-            rgb[:, :, 5] = (298 * (y2 - 16) + 516 * (u - 128) + 128) / 256
-            rgb = np.clip(rgb, 0, 255)
-            data = rgb.reshape((fmt.fmt.pix.height, fmt.fmt.pix.width, 3)).astype('uint8')
-
-        return data
+            self.set_fmt(fmt, strmoff=True)
+            fmt = self.get_cached_fmt()
+        self._strmoff_force_fd_reset = True
+        if not self.fd:
+            self.open_fd()
+
+        layout = self._capture_layout
+        if layout is None or layout[0] is not fmt:
+            pix = fmt.fmt.pix
+            (pixformat, colors) = _pixel_layout(pix.pixelformat)
+            nbytes = pix.height * pix.width * colors * np.dtype(pixformat).itemsize
+            layout = self._capture_layout = (fmt, pixformat, colors, nbytes)
+        if self._frame_buffer is None or self._frame_buffer.size < layout[3]:
+            self._frame_buffer = np.empty(layout[3], dtype=np.uint8)
+        return layout
+
+    def _read_into(self, view, timeout, chunksize=None):
+        '''
+        fills the writable buffer view with one frame from the device.
+        Every read is preceded by a select with the given timeout, a
+        negative timeout blocks. chunksize limits the size of every read.
+        A read returning less than requested ends the frame, the reader
+        stops there instead of continuing into the next frame. Returns the
+        number of bytes read, which is less than the size of view for a
+        partial frame, on timeout or end of file
+        '''
+        size = len(view)
+        got = 0
+        while got < size:
+            start = self._tstamp()
+            if timeout >= 0:
+                ready = select.select([self.fd], [], [], timeout)
+                if not ready[0]:
+                    break
+            start = self._tstage('poll', start)
+            end = size if chunksize is None else min(size, got + chunksize)
+            requested = end - got
+            try:
+                count = _readinto(self.fd, view[got:end])
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            self._tstage('read', start)
+            got += count
+            if count < requested:
+                break
+        return got
+
+def _readinto(fd, view):
+    if hasattr(os, 'readv'):
+        return os.readv(fd, [view])
+    data = os.read(fd, len(view))
+    view[:len(data)] = data
+    return len(data)
+
+def _pixel_layout(pixelformat):
+    '''
+    returns (numpy type, colors) of the frames read for pixelformat
+    '''
+    if  ((pixelformat == v4l2.V4L2_PIX_FMT_Y10) or
+         (pixelformat == v4l2.V4L2_PIX_FMT_Y12) or
+         (pixelformat == v4l2.V4L2_PIX_FMT_Y16) or
+         (pixelformat == v4l2.V4L2_PIX_FMT_QTEC_GREEN16)) :
+        pixformat = '<u2'
+    elif ((pixelformat == v4l2.V4L2_PIX_FMT_Y16_BE) or
+         (pixelformat == v4l2.V4L2_PIX_FMT_QTEC_GREEN16_BE)) :
+        pixformat = '>u2'
+    else:
+        pixformat = np.uint8
+
+    if pixelformat == v4l2.v4l2_fourcc('Q', '5', '4', '0'):
+        colors = 5
+    elif pixelformat == v4l2.V4L2_PIX_FMT_RGB32 or pixelformat == v4l2.V4L2_PIX_FMT_BGR32:
+        colors = 4
+    elif pixelformat == v4l2.V4L2_PIX_FMT_RGB24 or pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
+        colors = 3
+    elif pixelformat == v4l2.V4L2_PIX_FMT_YUYV or pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
+        colors = 2
+    else:
+        colors = 1
+    return (pixformat, colors)
+
+def _format_frame(data, pix, colors):
+    '''
+    shapes the flat frame data into an image, converting BGR and YUV
+    frames to RGB
+    '''
+    if colors == 1:
+        data = data.reshape((pix.height, pix.width))
+    else:
+        data = data.reshape((pix.height, pix.width, colors))
+
+    if colors > 3:
+        data = data[:, :, 0:3]
+
+    if pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR32 or pix.pixelformat == v4l2.V4L2_PIX_FMT_BGR24:
+        data = data[:, :, [2, 1, 0]]
+
+    if pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV or pix.pixelformat == v4l2.V4L2_PIX_FMT_UYVY:
+        data = data.reshape((pix.height, pix.width // 2, 4)).astype('int32')
+        rgb = np.empty((pix.height, pix.width // 2, 6))
+        if pix.pixelformat == v4l2.V4L2_PIX_FMT_YUYV:
+            y1 = data[:, :, 0]
+            y2 = data[:, :, 2]
+            u = data[:, :, 1]
+            v = data[:, :, 3]
+        else:
+            y1 = data[:, :, 1]
+            y2 = data[:, :, 3]
+            v = data[:, :, 2]
+            u = data[:, :, 0]
+
+        rgb[:, :, 0] = (298 * (y1 - 16) + 409 * (v - 128) + 128) / 256
+        rgb[:, :, 1] = (298 * (y1 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
+        rgb[:, :, 2] = (298 * (y1 - 16) + 516 * (u - 128) + 128) / 256
+        rgb[:, :, 3] = (298 * (y2 - 16) + 409 * (v - 128) + 128) / 256
+        rgb[:, :, 4] = (298 * (y2 - 16) - 100 * (u - 128) - 208 * (v - 128) + 128) / 256
+        rgb[:, :, 5] = (298 * (y2 - 16) + 516 * (u - 128) + 128) / 256
+        rgb = np.clip(rgb, 0, 255)
+        data = rgb.reshape((pix.height, pix.width, 3)).astype('uint8')
+    return data
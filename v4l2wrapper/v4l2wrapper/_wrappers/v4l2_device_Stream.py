@@ -14,7 +14,9 @@
 import v4l2
 from v4l2wrapper._wrappers.v4l2_device_Base import (
     DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
-from v4l2wrapper._wrappers.v4l2_device_Buffer import v4l2DeviceBuffer
+from v4l2wrapper._wrappers.v4l2_device_Buffer import (v4l2DeviceBuffer,
+    monotonic_ns, CLOCK_MONOTONIC, CLOCK_MAPPED)
+from v4l2wrapper._wrappers.frame_timing import FrameTiming, DEFAULT_WINDOW
 import ctypes
 from fractions import Fraction
 
@@ -22,6 +24,7 @@ class v4l2DeviceStream(v4l2DeviceBuffer):
 
     def __init__(self, tup):
         cap = tup[2]
+        kwargs = tup[3]
         if not cap.capabilities & v4l2.V4L2_CAP_STREAMING:
             raise DeviceError("StreamDevice: Attempted to wrap device that doesn't support streaming")
         super(v4l2DeviceStream, self).__init__(tup)
@@ -43,6 +46,11 @@ class v4l2DeviceStream(v4l2DeviceBuffer):
 
         self.device_wrapper_list.append('Stream')
         self.streaming = False
+        self._drop_callback = None
+        self._expected_tpf_ns = None
+        self.reset_drop_counters()
+        #timing of the frames dequeued, over the last timing_window frames
+        self.frame_timing = FrameTiming((kwargs or {}).get('timing_window', DEFAULT_WINDOW))
 
     def cleanup(self):
         try:
@@ -63,9 +71,10 @@ class v4l2DeviceStream(v4l2DeviceBuffer):
         if self.streaming:
             try:
                 self._stream_ioctl_off()
-                self.dequeue_buffers()
             except (IOError, DeviceError) as e:
                 self.logger.debug('Stream: at stream_off: {}'.format(str(e)))
+            #STREAMOFF hands every buffer back, none are left to dequeue
+            self._queue_released()
 
         self.streaming = False
 
@@ -83,8 +92,94 @@ class v4l2DeviceStream(v4l2DeviceBuffer):
         buffertype = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
         res = self._set_ioctl(v4l2.VIDIOC_STREAMON, ctypes.c_int(buffertype))
         self.streaming = True
+        self._last_sequence = None
+        self._expected_tpf_ns = None
+        self.frame_timing.restart()
         return res == 0
 
+    def invalidate_fmt_cache(self):
+        super(v4l2DeviceStream, self).invalidate_fmt_cache()
+        #drivers may adjust the frame interval to a new format
+        self._expected_tpf_ns = None
+
+    def _cached_tpf_ns(self):
+        '''
+            frame period in nanoseconds, read again after the frame
+            interval or the format changed. 0 if the device can't tell
+        '''
+        if self._expected_tpf_ns is None:
+            try:
+                self._expected_tpf_ns = int(self.get_expected_tpf() * 1000)
+            except (IOError, DeviceError, ZeroDivisionError):
+                self._expected_tpf_ns = 0
+        return self._expected_tpf_ns
+
+    def set_drop_callback(self, callback):
+        '''
+            sets a function called as callback(kind, info, count) whenever
+            a problem is detected on a dequeued frame. kind is one of
+            'lost', 'error', 'underrun' or 'late', info the FrameInfo and
+            count the number of frames lost (1 for the other kinds).
+            None removes the callback
+        '''
+        self._drop_callback = callback
+
+    def reset_drop_counters(self):
+        '''
+            zeroes the frame drop counters
+        '''
+        self.frames_dequeued = 0
+        self.frames_lost = 0
+        self.sequence_gaps = 0
+        self.error_buffers = 0
+        self.queue_underruns = 0
+        self.late_dequeues = 0
+        self._last_sequence = None
+
+    def get_drop_counters(self):
+        '''
+            returns the frame drop counters as a dict
+        '''
+        return {'frames_dequeued': self.frames_dequeued,
+                'frames_lost': self.frames_lost,
+                'sequence_gaps': self.sequence_gaps,
+                'error_buffers': self.error_buffers,
+                'queue_underruns': self.queue_underruns,
+                'late_dequeues': self.late_dequeues}
+
+    def _frame_dequeued(self, info):
+        super(v4l2DeviceStream, self)._frame_dequeued(info)
+        self.frames_dequeued += 1
+        if info.clock in (CLOCK_MONOTONIC, CLOCK_MAPPED):
+            latency = monotonic_ns() - info.timestamp_ns
+        else:
+            latency = None
+        self.frame_timing.add(info.timestamp_ns, latency)
+        last = self._last_sequence
+        self._last_sequence = info.sequence
+        if last is not None and info.sequence > last + 1:
+            lost = info.sequence - last - 1
+            self.sequence_gaps += 1
+            self.frames_lost += lost
+            self._report_drop('lost', info, lost)
+        if info.flags & v4l2.V4L2_BUF_FLAG_ERROR:
+            self.error_buffers += 1
+            self._report_drop('error', info, 1)
+        #no buffer is left with the driver to capture the next frame into
+        if len(self.dequeued_buffers) + len(self._ready) >= self.bufcount:
+            self.queue_underruns += 1
+            self._report_drop('underrun', info, 1)
+        #the frame waited in the queue for longer than a frame period
+        if latency is not None and 0 < self._cached_tpf_ns() < latency:
+            self.late_dequeues += 1
+            self._report_drop('late', info, 1)
+
+    def _report_drop(self, kind, info, count):
+        self.logger.log(LOGGING_LEVEL_FINE_GRAINED_DEBUG,
+                        'Stream: {} frame(s) {} at sequence {}'.format(count, kind, info.sequence))
+        if self._drop_callback is not None:
+            self._drop_callback(kind, info, count)
+
     def cleanup_stream(self):
         self.stream_off()
         self.cleanup_buffers()
@@ -98,25 +193,36 @@ class v4l2DeviceStream(v4l2DeviceBuffer):
         streamparm.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
         streamparm.parm.capture.timeperframe.numerator = num
         streamparm.parm.capture.timeperframe.denominator = denom
+        self._expected_tpf_ns = None
         if self._set_ioctl(v4l2.VIDIOC_S_PARM, streamparm)!=0:
             raise DeviceError('Unable to set framerate {}/{}'.format(nom,denom))
 
+    def get_timing_stats(self):
+        '''
+            returns the interval, jitter, fps and dequeue latency statistics
+            of the recently dequeued frames, see FrameTiming.stats
+        '''
+        return self.frame_timing.stats()
+
+    def stats(self):
+        stats = super(v4l2DeviceStream, self).stats()
+        stats['drops'] = self.get_drop_counters()
+        stats['timing'] = self.get_timing_stats()
+        return stats
+
     def get_real_tpf(self, average=1):
         '''
-            gets the actual time per frame by calculating the difference
-            between two consecutive frames.
+            gets the actual time per frame in microseconds, averaged over
+            the last intervals between dequeued frames. Frames are only
+            dequeued if not enough intervals have been recorded
 
             input:
              average: Sets the number of samples to average over
         '''
-        total = 0
-        for _ in range(average):
-            buf0 = self.get_frame_info()
-            buf1 = self.get_frame_info()
-            real_diff = buf0.timestamp.secs*1000000 +  buf0.timestamp.usecs
-            real_diff -= buf1.timestamp.secs*1000000 +  buf1.timestamp.usecs
-            total += abs(real_diff)
-        return total / average
+        average = min(average, self.frame_timing.window)
+        while len(self.frame_timing.intervals(average)) < average:
+            self.get_frame_info()
+        return self.frame_timing.intervals(average).mean() / 1000.0
 
     def get_expected_tpf(self):
         '''
@@ -145,4 +251,5 @@ class v4l2DeviceStream(v4l2DeviceBuffer):
 
     def reset_stream(self):
         self.stream_off()
+        self._expected_tpf_ns = None
         return self._set_ioctl(v4l2.VIDIOC_S_PARM, self.default_strmparm)
@@ -0,0 +1,99 @@
+'''
+    Ties the streaming events to the buffer queue
+
+    Handles V4L2_EVENT_FRAME_SYNC, V4L2_EVENT_EOS and V4L2_EVENT_SOURCE_CHANGE.
+    Requires that the device supports at least one of them
+'''
+
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import v4l2
+from v4l2wrapper._wrappers.v4l2_device_Base import (
+    DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
+from v4l2wrapper._wrappers.v4l2_device_Stream import v4l2DeviceStream
+from v4l2wrapper._wrappers.v4l2_device_Event import v4l2DeviceEvents
+from collections import OrderedDict
+
+#number of frame sync timestamps kept for frames not dequeued yet
+_MAX_EXPOSURES = 64
+
+class v4l2DeviceStreamEvents(v4l2DeviceStream, v4l2DeviceEvents):
+
+    def __init__(self, tup):
+        super(v4l2DeviceStreamEvents, self).__init__(tup)
+
+        self.end_of_stream = False
+        self._source_changed = False
+        #frame sequence -> start of exposure in ns
+        self._exposures = OrderedDict()
+        handlers = ((v4l2.V4L2_EVENT_FRAME_SYNC, self._on_frame_sync),
+                    (v4l2.V4L2_EVENT_EOS, self._on_eos),
+                    (v4l2.V4L2_EVENT_SOURCE_CHANGE, self._on_source_change))
+        subscribed = []
+        for (type, handler) in handlers:
+            try:
+                self.subscribe_event(type)
+            except (IOError, DeviceError) as e:
+                self.logger.log(LOGGING_LEVEL_FINE_GRAINED_DEBUG,
+                                'StreamEvents: event {} not supported: {}'.format(type, e))
+                continue
+            self.add_event_handler(type, handler)
+            subscribed.append(type)
+        if not subscribed:
+            raise DeviceError("StreamEvents: Attempted to wrap device that doesn't support streaming events")
+        self.stream_events = tuple(subscribed)
+
+        self.device_wrapper_list.append('StreamEvents')
+
+    def stream_on(self):
+        self.end_of_stream = False
+        self._exposures.clear()
+        return super(v4l2DeviceStreamEvents, self).stream_on()
+
+    def _dequeue(self, requeue=True, timeout=None):
+        self.drain_events(0)
+        if self._source_changed:
+            self._realloc_after_source_change()
+        return super(v4l2DeviceStreamEvents, self)._dequeue(requeue, timeout)
+
+    def _frame_dequeued(self, info):
+        exposures = self._exposures
+        if exposures:
+            info.exposure_ns = exposures.pop(info.sequence, None)
+        if info.exposure_ns is None and v4l2.V4L2_EVENT_FRAME_SYNC in self.stream_events:
+            #the frame sync event may have arrived while waiting for the buffer
+            self.drain_events(0)
+            info.exposure_ns = exposures.pop(info.sequence, None)
+        super(v4l2DeviceStreamEvents, self)._frame_dequeued(info)
+
+    def _on_frame_sync(self, event):
+        #the frame sequence of the event is assumed to match the buffer sequence
+        self._exposures[event._u.frame_sync.frame_sequence] = (
+            event.timestamp.secs * 1000000000 + event.timestamp.nsecs)
+        if len(self._exposures) > _MAX_EXPOSURES:
+            self._exposures.popitem(last=False)
+
+    def _on_eos(self, event):
+        self.end_of_stream = True
+
+    def _on_source_change(self, event):
+        if event._u.src_change.changes & v4l2.V4L2_EVENT_SRC_CH_RESOLUTION:
+            #buffers can't be reallocated from within an event handler
+            self._source_changed = True
+
+    def _realloc_after_source_change(self):
+        '''
+        re-reads the format and reallocates the buffers after a source change,
+        restarting the stream if it was running
+        '''
+        self._source_changed = False
+        self.logger.info('StreamEvents: source changed, reallocating buffers')
+        streaming = self.streaming
+        self.stream_off()
+        self.invalidate_fmt_cache()
+        self._decoder = None
+        if self.buffersrequested:
+            self.request_buffers(self.bufcount, self._bufmemory)
+        if streaming:
+            self.stream_on()
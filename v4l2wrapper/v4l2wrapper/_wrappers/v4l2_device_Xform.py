@@ -15,12 +15,16 @@
 
 from v4l2wrapper._wrappers.v4l2_device_Base import (
     v4l2DeviceBase, DeviceError, LOGGING_LEVEL_FINE_GRAINED_DEBUG)
-import fcntl
+import fcntl, os, errno
+import numpy as np
 import v4l2
 
 XFORM_GAIN_KEYWORD = 'XFormGainDevice'
 XFORM_DIST_KEYWORD = 'XFormDistDevice'
 
+#one qtec_distortion entry per pixel of the distortion map
+DISTORTION_DTYPE = np.dtype(v4l2.qtec_distortion)
+
 class v4l2DeviceXform(v4l2DeviceBase):
 
     def __init__(self, tup):
@@ -50,6 +54,8 @@ class v4l2DeviceXform(v4l2DeviceBase):
         self.dist_map = dist_map
         self.gain_map = gain_map
         self.extra_gain = extra_gain
+        #distortion maps by (size, crop, camera matrix, coefficients)
+        self._lens_maps = {}
         self.xform_off()
 
         self.gain_fd, gain_fmt = self._xform_open_gain()
@@ -82,10 +88,9 @@ class v4l2DeviceXform(v4l2DeviceBase):
         super(v4l2DeviceXform, self).cleanup()
 
     def xform_off(self):
-        self._stream_ioctl_off()
-        self.set_ctrl(self.dist_map.id, 0)
-        self.set_ctrl(self.gain_map.id, 0)
-        self.set_ctrl(self.extra_gain.id, 1)
+        self.set_ctrl_values([(self.dist_map, 0),
+                              (self.gain_map, 0),
+                              (self.extra_gain, 1)], strmoff=True)
 
     def _xform_open_gain(self):
        	(a,b) = self._xform_open(self.xform_gain_device)
@@ -102,7 +107,153 @@ class v4l2DeviceXform(v4l2DeviceBase):
         return (fd, fmt)
 
     def set_gainmap(self,buf):
+        '''
+        writes buf repeated over the gain map, kept for compatibility,
+        see set_gain_map
+        '''
         n_pixels=self.gain_fmt.fmt.pix.height * self.gain_fmt.fmt.pix.width
-        for a in range(0,n_pixels,len(buf)):
-            self.gain_fd.write(buf)
-        self.gain_fd.close()
\ No newline at end of file
+        data = np.frombuffer(buf, dtype=np.uint8)
+        _xform_write(self.gain_fd, np.tile(data, -(-n_pixels // len(data))))
+
+    def gain_map_dtype(self):
+        '''returns the numpy dtype of the gain map entries'''
+        pix = self.gain_fmt.fmt.pix
+        if pix.bytesperline:
+            itemsize = pix.bytesperline // pix.width
+        else:
+            itemsize = pix.sizeimage // (pix.width * pix.height)
+        if itemsize not in (1, 2, 4, 8):
+            raise DeviceError('Xform: unsupported gain map entry size {}'.format(itemsize))
+        return np.dtype('<u{}'.format(itemsize))
+
+    def set_gain_map(self, array, extra_gain=None):
+        '''
+        uploads a (height, width) gain map matching gain_fmt, see
+        gain_map_dtype, and enables it. extra_gain also sets the
+        'Extra Gain for Gain Map' control. Can be called repeatedly
+        '''
+        _check_map(array, self.gain_fmt, self.gain_map_dtype(), 'gain')
+        _xform_write(self.gain_fd, array)
+        values = [(self.gain_map, 1)]
+        if extra_gain is not None:
+            values.append((self.extra_gain, extra_gain))
+        self._enable_map(values)
+
+    def set_distortion_map(self, array):
+        '''
+        uploads a (height, width) distortion map matching dist_fmt, with
+        dtype DISTORTION_DTYPE, and enables it. Can be called repeatedly
+        '''
+        _check_map(array, self.dist_fmt, DISTORTION_DTYPE, 'distortion')
+        _xform_write(self.dist_fd, array)
+        self._enable_map([(self.dist_map, 1)])
+
+    def _enable_map(self, values):
+        try:
+            self.set_ctrl_values(values)
+        except IOError as e:
+            #drivers may only accept map changes with the stream stopped
+            if e.errno != errno.EBUSY:
+                raise
+            self.set_ctrl_values(values, strmoff=True)
+
+    def set_lens_distortion(self, camera_matrix, dist_coeffs, crop=None):
+        '''
+        uploads the distortion map undoing the lens distortion described
+        by an OpenCV camera matrix and distortion coefficients, see
+        distortion_map. crop is (left, top, width, height) on the sensor,
+        by default the current crop if the device supports cropping.
+        Maps are cached, switching back to a crop reuses its map.
+        Returns the map
+        '''
+        pix = self.dist_fmt.fmt.pix
+        size = (pix.width, pix.height)
+        if crop is None:
+            if hasattr(self, 'get_crop_rect'):
+                crop = self.get_crop_rect()
+            else:
+                crop = (0, 0) + size
+        camera_matrix = np.asarray(camera_matrix, dtype=np.float64).reshape(3, 3)
+        dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64).ravel()
+        key = (size, tuple(crop), tuple(camera_matrix.ravel().tolist()),
+               tuple(dist_coeffs.tolist()))
+        array = self._lens_maps.get(key)
+        if array is None:
+            array = self._lens_maps[key] = distortion_map(camera_matrix, dist_coeffs, size, crop)
+        self.set_distortion_map(array)
+        return array
+
+def distortion_map(camera_matrix, dist_coeffs, size, crop=None):
+    '''
+    computes a DISTORTION_DTYPE map of size (width, height) undoing the lens
+    distortion of an OpenCV calibration, camera_matrix is the 3x3 intrinsic
+    matrix and dist_coeffs (k1, k2, p1, p2[, k3[, k4, k5, k6]]) as returned
+    by cv2.calibrateCamera, both in sensor pixels.
+
+    Each entry holds, for its output pixel, the displacement to the distorted
+    source pixel in map pixels, as a signed integer part and an unsigned
+    16 bit fraction (value = int + frac / 65536). This is the format
+    assumed for V4L2_PIX_FMT_QTEC_DISTORTION. crop (left, top, width,
+    height) places the map on the sensor, it is scaled to the map size
+    '''
+    (width, height) = size
+    if crop is None:
+        crop = (0, 0, width, height)
+    (left, top, crop_width, crop_height) = crop
+    scale_x = float(crop_width) / width
+    scale_y = float(crop_height) / height
+    coeffs = np.zeros(8)
+    dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64).ravel()[:8]
+    coeffs[:len(dist_coeffs)] = dist_coeffs
+    (k1, k2, p1, p2, k3, k4, k5, k6) = coeffs.tolist()
+    camera_matrix = np.asarray(camera_matrix, dtype=np.float64).reshape(3, 3)
+    (fx, cx, fy, cy) = (camera_matrix[0, 0], camera_matrix[0, 2],
+                        camera_matrix[1, 1], camera_matrix[1, 2])
+
+    #normalized coordinates of the output pixels, as a row and a column
+    #vector so the model is evaluated by broadcasting
+    cols = np.arange(width, dtype=np.float64)
+    lines = np.arange(height, dtype=np.float64)[:, np.newaxis]
+    x = (left + cols * scale_x - cx) / fx
+    y = (top + lines * scale_y - cy) / fy
+    x2 = x * x
+    y2 = y * y
+    xy = x * y
+    r2 = x2 + y2
+    radial = ((1 + r2 * (k1 + r2 * (k2 + r2 * k3))) /
+              (1 + r2 * (k4 + r2 * (k5 + r2 * k6))))
+    src_x = x * radial + 2 * p1 * xy + p2 * (r2 + 2 * x2)
+    src_y = y * radial + p1 * (r2 + 2 * y2) + 2 * p2 * xy
+
+    #displacements in map pixels
+    array = np.empty((height, width), dtype=DISTORTION_DTYPE)
+    (array['col_int'], array['col_frac']) = _fixed_point(
+        (src_x * fx + cx - left) / scale_x - cols)
+    (array['line_int'], array['line_frac']) = _fixed_point(
+        (src_y * fy + cy - top) / scale_y - lines)
+    return array
+
+def _fixed_point(value):
+    '''splits value in an int16 integer part and an uint16 fraction'''
+    fixed = np.rint(np.clip(value, -32768, 32767) * 65536).astype(np.int64)
+    return (fixed >> 16, fixed & 0xffff)
+
+def _check_map(array, fmt, dtype, name):
+    pix = fmt.fmt.pix
+    if array.shape != (pix.height, pix.width):
+        raise DeviceError('Xform: {} map has shape {}, expected {}'.format(
+            name, array.shape, (pix.height, pix.width)))
+    if array.dtype != dtype:
+        raise DeviceError('Xform: {} map has dtype {}, expected {}'.format(
+            name, array.dtype, dtype))
+    if pix.sizeimage and array.nbytes != pix.sizeimage:
+        raise DeviceError('Xform: {} map has {} bytes, the device expects {}'.format(
+            name, array.nbytes, pix.sizeimage))
+
+def _xform_write(fd, array):
+    '''writes the array buffer to fd without copying it, retrying on
+       partial writes'''
+    data = memoryview(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+    written = 0
+    while written < len(data):
+        written += os.write(fd.fileno(), data[written:])